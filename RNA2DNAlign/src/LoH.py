@@ -62,16 +62,27 @@ parser.add_option("-s", "--snvs", type="files", dest="snvs", default=None,
                   notNone=True, remember=True,
                   filetypes=[("SNVs", "*.vcf;*.csv;*.tsv;*.xls;*.xlsx;*.txt")])
 parser.add_option("-r", "--readalignments", type="files", dest="alignments", default=None,
-                  help="Read alignments in BAM/SAM format. Required.", name="Read Alignments",
+                  help="Read alignments in BAM/CRAM/SAM format. Required.", name="Read Alignments",
                   notNone=True, remember=True,
-                  filetypes=[("Read Alignments (BAM/SAM Format)", "*.bam;*.sam")])
+                  filetypes=[("Read Alignments (BAM/CRAM/SAM Format)", "*.bam;*.cram;*.sam")])
 advanced.add_option("-M", "--mincount", type="int", dest="mincount", default=3, remember=True,
                     help="Minimum number of reads for reference and variant allelels to apply LoH test. Default: 3.",
                     name="Min. Count")
+advanced.add_option("--prescreen", action="store_true", dest="prescreen", default=False, remember=True,
+                    help="Drop SNV loci that cannot have --mincount reads of both alleles, by upper bounds on the read depth of each indexed alignment file, before any pileup. The bounds are counted from each file's index, only for the regions of the SNV loci, and cached next to it (.cov.npz). Default=False.", name="Coverage Pre-screen")
 advanced.add_option("-F", "--full", action="store_true", dest="full", default=False, remember=True,
                     help="Output extra diagnostic read count fields. Default=False.", name="All Fields")
 advanced.add_option("-U", "--uniquereads", action="store_true", dest="unique", default=False, remember=True,
                     help="Consider only distinct reads.", name="Unique Reads")
+advanced.add_option("--decompressthreads", type="int", dest="bgzfthreads", default=0, remember=True,
+                    help="htslib decompression threads for each open alignment file, if supported by pysam. Indicate no decompression threads with 0, or one thread per available CPU, shared between the open alignment files, with -1. Default=0.", name="Decompression Threads")
+advanced.add_option("--reference", type="file", dest="reference", default="", remember=True,
+                    help="Reference sequence FASTA file for decoding CRAM read alignments. Default=htslib reference lookup by MD5 checksum.", name="CRAM Reference",
+                    filetypes=[("Reference Sequence (FASTA)", "*.fa;*.fasta;*.fna")])
+advanced.add_option("--refcache", type="savedir", dest="refcache", default="", remember=True,
+                    help="Local directory caching reference sequences htslib looks up by MD5 checksum for CRAM read alignments. Default=htslib default (REF_CACHE).", name="CRAM Reference Cache")
+advanced.add_option("--approxdepth", type="int", dest="approxdepth", default=0, remember=True,
+                    help="Replace exact binomial and Fisher exact tests on at least this many reads by saddle-point approximations, within 0.02 of the exact scores (-10log10 p-value). Indicate exact tests with 0. Default=0.", name="Approx. Stats Depth")
 advanced.add_option("-q", "--quiet", action="store_true", dest="quiet", default=False, remember=True,
                     help="Quiet.", name="Quiet")
 parser.add_option("-o", "--output", type="savefile", dest="output", remember=True,
@@ -98,7 +109,8 @@ if not opt.output:
     opt.quiet = True
 progress = ProgressText(quiet=opt.quiet)
 
-from pysamimport import pysam                                                   
+from pysamimport import pysam, openalignments, decompressionthreads, setreference, hasindex
+from coverage import CoverageBins
 from dataset import XLSFileTable, CSVFileTable, TSVFileTable, XLSXFileTable, TXTFileTable, BEDFile, VCFFile
 
 progress.stage("Read SNV data", len(opt.snvs))
@@ -165,15 +177,35 @@ extrasnvheaders = filter(lambda h: h in usedsnvheaders, extrasnvheaders)
 progress.message("SNVs: %d" % len(snvdata))
 
 samfiles = []
+setreference(opt.reference or None, opt.refcache)
+bgzfthreads = decompressionthreads(opt.bgzfthreads, len(opt.alignments))
 for al in opt.alignments:
     if al.lower().endswith('.bam'):
-        samfile = pysam.Samfile(al, "rb")
+        samfile = openalignments(al, "rb", threads=bgzfthreads, index=False)
+    elif al.lower().endswith('.cram'):
+        samfile = openalignments(al, "rc", threads=bgzfthreads, index=False)
     elif al.lower().endswith('.sam'):
-        samfile = pysam.Samfile(al, "r")
+        samfile = openalignments(al, "r", index=False)
     else:
         raise RuntimeError("Unexpected alignments file extension: %s." % al)
     samfiles.append(samfile)
 
+# Loci with fewer than --mincount reads for each of the reference and
+# variant alleles, by the coverage bounds of all the alignment files (see
+# CoverageBins), are dropped before any pileup. Needs indexed files.
+if opt.prescreen and opt.mincount > 0 and all(map(hasindex, samfiles)):
+    progress.stage("Pre-screen SNV loci by coverage", len(opt.alignments))
+    bounds = [0]*len(snvdata)
+    for al in opt.alignments:
+        bins = CoverageBins(al, threads=bgzfthreads)
+        for j, (snvchr, snvpos, ref, alt, snvextra) in enumerate(snvdata):
+            bounds[j] += bins.bound(snvchr, snvpos - 1)
+        bins.save()
+        progress.update()
+    progress.done()
+    snvdata = [ s for s, b in zip(snvdata, bounds) if b >= 2 * opt.mincount ]
+    progress.message("Pre-screened SNVs: %d" % len(snvdata))
+
 outheaders = snvheaders + filter(None, """
 SNVCount
 NoSNVCount
@@ -229,7 +261,8 @@ else:
 
 outrows = []
 
-from fisher import fisher_exact, bonferroni, fdr, lod, binom_test
+from fisher import fisher_exact, bonferroni, fdr, lod, binom_test, setapproxdepth
+setapproxdepth(opt.approxdepth)
 pvalues = []
 
 progress.stage("Count reads per SNV", len(snvdata))
@@ -79,9 +79,9 @@ parser.add_option("-s", "--snvs", type="files", dest="snvs", default=None,
                   notNone=True, remember=True,
                   filetypes=[("SNV Files", "*.vcf;*.csv;*.tsv;*.xls;*.xlsx;*.txt")])
 parser.add_option("-r", "--readalignments", type="files", dest="alignments", default=None,
-                  help="Read alignment files in indexed BAM format. Required.", name="Read Alignment Files",
+                  help="Read alignment files in indexed BAM or CRAM format. Required.", name="Read Alignment Files",
                   notNone=True, remember=True,
-                  filetypes=[("Read Alignment Files (Indexed BAM)", "*.bam")])
+                  filetypes=[("Read Alignment Files (Indexed BAM/CRAM)", "*.bam;*.cram")])
 exfilt.add_option("-e", "--exoncoords", type="file", dest="exoncoords", default=None,
                   help="Exon coordinates for SNV filtering. Optional.", name="Exon Coords.",
                   remember=True,
@@ -104,6 +104,8 @@ snvannot.add_option("-d", "--darned", type="file", dest="darned", default="",
 snvannot.add_option("-c", "--cosmic", type="file", dest="cosmic", default="",
                     help="COSMIC Annotations. Optional.", remember=True,
                     filetypes=[("COSMIC Annotations", "*.tsv;*.tsv.gz")])
+readcounts.add_option("-G", "--groupby", type="str", dest="groupby", default="", remember=True,
+                      help="Count the reads of each read group label of an alignment file separately, with read groups labelled by this field of their @RG header line (SM for samples, ID, LB, ...). The filename regular expressions are matched against alignment file and read group label. Default=Count each alignment file as a whole.", name="Group Reads By")
 readcounts.add_option("-m", "--minreads", type="int", dest="minreads", default=10, remember=True,
                       help="Minimum number of good reads at SNV locus per alignment file. Default=10.", name="Min. Reads")
 readcounts.add_option("-M", "--maxreads", type="float", dest="maxreads", default=None, remember=True,
@@ -115,6 +117,13 @@ readcounts.add_option("-U", "--uniquereads", action="store_true", dest="unique",
 readcounts.add_option("-t", "--threadsperbam", type="int", dest="tpb", default=1, remember=True,
                     help="Worker threads per alignment file. Indicate no threading with 0. Default=1.",
                       name="Threads/BAM")
+readcounts.add_option("--reference", type="file", dest="reference", default="", remember=True,
+                      help="Reference sequence FASTA file for decoding CRAM read alignment files. Default=htslib reference lookup by MD5 checksum.", name="CRAM Reference",
+                      filetypes=[("Reference Sequence (FASTA)", "*.fa;*.fasta;*.fna")])
+readcounts.add_option("--refcache", type="savedir", dest="refcache", default="", remember=True,
+                      help="Local directory caching reference sequences htslib looks up by MD5 checksum for CRAM read alignment files. Default=htslib default (REF_CACHE).", name="CRAM Reference Cache")
+readcounts.add_option("--approxdepth", type="int", dest="approxdepth", default=0, remember=True,
+                      help="Replace exact binomial tests on at least this many reads by saddle-point approximations, within 0.02 of the exact scores (-10log10 p-value). Indicate exact tests with 0. Default=0.", name="Approx. Stats Depth")
 readcounts.add_option("-q", "--quiet", action="store_true", dest="quiet", default=False, remember=True,
                       help="Quiet.", name="Quiet")
 
@@ -177,6 +186,14 @@ if not os.path.exists(outfile) or True:
         args.append("-f")
     if opt.unique:
         args.append("-U")
+    if opt.groupby:
+        args.extend(["-G", opt.groupby])
+    if opt.reference:
+        args.extend(["--reference", opt.reference])
+    if opt.refcache:
+        args.extend(["--refcache", opt.refcache])
+    if opt.approxdepth:
+        args.extend(["--approxdepth", str(opt.approxdepth)])
     if opt.quiet:
         args.append("-q")
 
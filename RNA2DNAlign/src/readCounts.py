@@ -14,6 +14,7 @@ import atexit
 import subprocess
 import time
 import math
+import cPickle
 from collections import defaultdict, Counter
 from os.path import join, dirname, realpath
 try:
@@ -24,9 +25,12 @@ except NameError:
 from optparse_gui import OptionParser, OptionGroup, GUI, UserCancelledError, ProgressText
 from util import *
 from fisher import *
-from pileups import SerialPileups, ThreadedPileups, MultiprocPileups
+from pileups import SerialPileups, WindowedPileups, FetchPileups, PrefetchPileups, ThreadedPileups, MultiprocPileups, ShardedPileups, lociGoodReads, alignmentcolumns
 from chromreg import ChromLabelRegistry
-from operator import itemgetter
+from pysamimport import openalignments, decompressionthreads, setreference
+from coverage import CoverageBins
+from itertools import izip
+import numpy
 
 from version import VERSION
 VERSION = '1.0.7 (%s)' % (VERSION,)
@@ -58,19 +62,30 @@ else:
     parser = OptionParser(version=VERSION)
     error_kwargs = {}
 
+# Merging shard partials needs neither SNVs nor read alignments
+merging = (len(filter(lambda a: a == '--merge' or a.startswith('--merge='), sys.argv[1:])) > 0)
+
 advanced = OptionGroup(parser, "Advanced")
 parser.add_option("-s", "--snvs", type="files", dest="snvs", default=None,
-                  help="Single-Nucleotide-Variant files. Required.", name="SNV Files",
-                  notNone=True, remember=True,
+                  help="Single-Nucleotide-Variant files. Required, except with --merge.", name="SNV Files",
+                  notNone=(not merging), remember=True,
                   filetypes=[("SNV Files", "*.vcf;*.csv;*.tsv;*.xls;*.xlsx;*.txt")])
 parser.add_option("-r", "--readalignments", type="files", dest="alignments", default=None,
-                  help="Read alignment files in indexed BAM format. Required.", name="Read Alignment Files",
-                  notNone=True, remember=True,
-                  filetypes=[("Read Alignment Files (indexed BAM)", "*.bam")])
+                  help="Read alignment files in indexed BAM or CRAM format. Required, except with --merge.", name="Read Alignment Files",
+                  notNone=(not merging), remember=True,
+                  filetypes=[("Read Alignment Files (indexed BAM/CRAM)", "*.bam;*.cram")])
+advanced.add_option("-G", "--groupby", type="str", dest="groupby", default="", remember=True,
+                    help="Count the reads of each read group label of an alignment file separately, with read groups labelled by this field of their @RG header line (SM for samples, ID, LB, ...). Read counts are labelled by alignment file and read group label. Default=Count each alignment file as a whole.", name="Group Reads By")
 advanced.add_option("-m", "--minreads", type="int", dest="minreads", default=10, remember=True,
                     help="Minimum number of good reads at SNV locus per alignment file. Default=10.", name="Min. Reads")
 advanced.add_option("-M", "--maxreads", type="float", dest="maxreads", default=None, remember=True,
                     help="Scale read counts at high-coverage loci to ensure at most this many good reads at SNV locus per alignment file. Values greater than 1 indicate absolute read counts, otherwise the value indicates the coverage distribution percentile. Default=No maximum.", name="Max. Reads")
+advanced.add_option("-D", "--downsample", action="store_true", dest="downsample", default=False, remember=True,
+                    help="Downsample reads at SNV loci with more than --maxreads good reads, rather than scaling the read counts. Reads are examined in a reproducible order determined by the read name until --maxreads are good. Percentile --maxreads values are estimated from the good reads at a sample of the SNV loci. Downsampled read counts are not scaled. Default=False.", name="Downsample Reads")
+advanced.add_option("--maxdepth", type="int", dest="maxdepth", default=8000, remember=True,
+                    help="Maximum number of reads at SNV locus per alignment file considered by the pileup. Default=8000.", name="Max. Pileup Depth")
+advanced.add_option("--prescreen", action="store_true", dest="prescreen", default=False, remember=True,
+                    help="Drop SNV loci at which an alignment file cannot have --minreads good reads, by upper bounds on its read depth, before any pileup. The bounds are counted from each file's index, only for the regions of the SNV loci, and cached next to it (.cov.npz). Default=False.", name="Coverage Pre-screen")
 advanced.add_option("-F", "--full", action="store_true", dest="full", default=False, remember=True,
                     help="Output extra diagnostic read count fields. Default=False.", name="All Fields")
 advanced.add_option("-f", "--alignmentfilter", action="store_false", dest="filter", default=True, remember=True,
@@ -79,6 +94,35 @@ advanced.add_option("-U", "--uniquereads", action="store_true", dest="unique", d
                     help="Consider only distinct reads.", name="Unique Reads")
 advanced.add_option("-t", "--threadsperbam", type="int", dest="tpb", default=0, remember=True,
                     help="Worker threads per alignment file. Indicate no threading with 0. Default=0.", name="Threads/BAM")
+advanced.add_option("-P", "--prefetch", type="int", dest="prefetch", default=0, remember=True,
+                    help="Without threads per alignment file, pile up SNV loci in a background thread at most this many SNV loci ahead of read counting. Indicate no prefetching with 0. Default=0.", name="Prefetch Loci")
+advanced.add_option("--readahead", type="int", dest="readahead", default=0, remember=True,
+                    help="With --prefetch, read this many kilobytes of each alignment file at each upcoming SNV locus ahead of the pileups, into the operating system's file cache. Indicate no read-ahead with 0. Default=0.", name="Read-ahead (KB)")
+advanced.add_option("-W", "--window", type="int", dest="window", default=0, remember=True,
+                    help="Pile up SNV loci at most this many bases apart using a single pileup iterator. Indicate one pileup per SNV locus with 0. Default=0.", name="Pileup Window")
+advanced.add_option("--fetch", action="store_true", dest="fetch", default=False, remember=True,
+                    help="Count reads for SNV loci at most --window bases apart (default 150) from a single pass over the reads, rather than a pileup per SNV locus. Ignores --maxdepth. Default=False.", name="Fetch Reads")
+advanced.add_option("--fileorder", action="store_true", dest="fileorder", default=False, remember=True,
+                    help="Visit the SNV loci in each indexed BAM file in the order of their reads in the file, rather than the order of the SNV loci, for mostly sequential reads when the files disagree on the chromosome order. Default=False.", name="File Order")
+advanced.add_option("-S", "--shards", type="int", dest="shards", default=0, remember=True,
+                    help="Worker processes, each counting reads in all alignment files for a contiguous shard of the SNV loci. Overrides threads per alignment file. Indicate no sharding with 0. Default=0.", name="Shard Processes")
+advanced.add_option("--shardby", type="choice", dest="shardby", default="range", remember=True,
+                    choices=["range", "chromosome"],
+                    help="Shard the SNV loci by chromosome or by genomic ranges with similar numbers of loci. Default=range.", name="Shard By")
+advanced.add_option("--shard", type="str", dest="shard", default="", remember=False,
+                    help="Count reads for shard i of N (i/N) of the SNV loci only, and output uncorrected partial read counts (.partial) for --merge.", name="Shard")
+advanced.add_option("--merge", type="files", dest="merge", default=None, remember=False,
+                    help="Merge partial read counts from all N shards and output the read counts, p-values, FDR and scores.", name="Merge Shards",
+                    filetypes=[("Partial read counts", "*.partial")])
+advanced.add_option("--decompressthreads", type="int", dest="bgzfthreads", default=0, remember=True,
+                    help="htslib decompression threads for each open alignment file, if supported by pysam. Indicate no decompression threads with 0, or one thread per available CPU, shared between the open alignment files and their worker threads or processes, with -1. Default=0.", name="Decompression Threads")
+advanced.add_option("--reference", type="file", dest="reference", default="", remember=True,
+                    help="Reference sequence FASTA file for decoding CRAM read alignment files. Default=htslib reference lookup by MD5 checksum.", name="CRAM Reference",
+                    filetypes=[("Reference Sequence (FASTA)", "*.fa;*.fasta;*.fna")])
+advanced.add_option("--refcache", type="savedir", dest="refcache", default="", remember=True,
+                    help="Local directory caching reference sequences htslib looks up by MD5 checksum for CRAM read alignment files. Default=htslib default (REF_CACHE).", name="CRAM Reference Cache")
+advanced.add_option("--approxdepth", type="int", dest="approxdepth", default=0, remember=True,
+                    help="Replace exact binomial and Fisher exact tests on at least this many reads by saddle-point approximations, within 0.02 of the exact scores (-10log10 p-value). Indicate exact tests with 0. Default=0.", name="Approx. Stats Depth")
 advanced.add_option("-q", "--quiet", action="store_true", dest="quiet", default=False, remember=True,
                     help="Quiet.", name="Quiet")
 advanced.add_option("-d", "--debug", action="store_true", dest="debug", default=False, remember=True,
@@ -87,7 +131,8 @@ parser.add_option("-o", "--output", type="savefile", dest="output", remember=Tru
                   help="Output file. Leave empty for console ouptut.", default="",
                   name="Output File", filetypes=[("All output formats", "*.xlsx;*.xls;*.csv;*.tsv;*.txt"),
                                                  ("Excel", "*.xlsx"), ("Excel2003", "*.xls"),
-                                                 ("CSV", "*.csv"), ("TSV", "*.tsv"), ("Text", "*.txt")])
+                                                 ("CSV", "*.csv"), ("TSV", "*.tsv"), ("Text", "*.txt"),
+                                                 ("Partial read counts", "*.partial")])
 parser.add_option_group(advanced)
 
 opt = None
@@ -102,97 +147,193 @@ while True:
 
     break
 
+shard = None
+if opt.shard:
+    m = re.search(r'^(\d+)/(\d+)$', opt.shard.strip())
+    if not m or not (1 <= int(m.group(1)) <= int(m.group(2))):
+        parser.error("Bad shard %s, expected i/N with 1 <= i <= N" % (opt.shard,))
+    shard = (int(m.group(1)), int(m.group(2)))
+    if opt.merge:
+        parser.error("Options --shard and --merge are mutually exclusive")
+    if not opt.output.endswith('.partial'):
+        parser.error("Shard output file must have extension .partial")
+elif opt.output.endswith('.partial'):
+    parser.error("Partial read counts (.partial) are output only with --shard")
+
+PARTIALFORMAT = "readCounts partial read counts 1"
+
+def readpartials(filenames):
+    partials = []
+    for filename in filenames:
+        rh = open(filename, 'rb')
+        partial = cPickle.load(rh)
+        rh.close()
+        if not isinstance(partial, dict) or partial.get('format') != PARTIALFORMAT:
+            raise RuntimeError("Not a readCounts partial read counts file: %s" % filename)
+        partials.append(partial)
+    if len(partials) == 0:
+        raise RuntimeError("No partial read counts files to merge")
+    partials.sort(key=lambda p: p['shard'])
+    first = partials[0]
+    if map(lambda p: p['shard'], partials) != range(1, first['shards'] + 1):
+        raise RuntimeError("Partial read counts for shards %s, expected shards 1-%d exactly once" %
+                           (",".join(map(lambda p: str(p['shard']), partials)), first['shards']))
+    for k in ('shards', 'snvs', 'outheaders', 'alignments', 'options'):
+        for p in partials:
+            if p[k] != first[k]:
+                raise RuntimeError("Partial read counts for shards %d and %d do not match (%s)" %
+                                   (first['shard'], p['shard'], k))
+    if first['outheaders'] != outheaders:
+        raise RuntimeError("Partial read counts from a different version of readCounts")
+    rows = []
+    for p in partials:
+        rows.extend(p['rows'])
+    return rows, first['options']
+
 progress = None
 if not opt.output:
     opt.quiet = True
 if opt.maxreads == None:
     opt.maxreads = 1e+20
+if opt.debug:
+    atexit.register(memoreport)
+setapproxdepth(opt.approxdepth)
 progress = ProgressText(quiet=opt.quiet)
 
 from dataset import XLSFileTable, CSVFileTable, TSVFileTable, XLSXFileTable, TXTFileTable, BEDFile, VCFFile
 
-progress.stage("Read SNV data", len(opt.snvs))
 snvheaders = filter(None, """
 CHROM POS REF ALT
 """.split())
 
-snvdata = {}
-# extrasnvheaders = []
-# usedsnvheaders = set()
-snvchroms = defaultdict(set)
-for filename in opt.snvs:
-
-    base, extn = filename.rsplit('.', 1)
-    extn = extn.lower()
-    if extn == 'csv':
-        snvs = CSVFileTable(filename=filename)
-    elif extn == 'vcf':
-        snvs = VCFFile(filename=filename)
-    elif extn == 'tsv':
-        snvs = TSVFileTable(filename=filename)
-    elif extn == 'xls':
-        snvs = XLSFileTable(filename=filename)
-    elif extn == 'xlsx':
-        snvs = XLSXFileTable(filename=filename)
-    elif extn == 'txt':
-        snvs = TXTFileTable(filename=filename, headers=snvheaders)
+if not opt.merge:
+
+    progress.stage("Read SNV data", len(opt.snvs))
+
+    snvdata = {}
+    # extrasnvheaders = []
+    # usedsnvheaders = set()
+    snvchroms = defaultdict(set)
+    for filename in opt.snvs:
+
+        base, extn = filename.rsplit('.', 1)
+        extn = extn.lower()
+        if extn == 'csv':
+            snvs = CSVFileTable(filename=filename)
+        elif extn == 'vcf':
+            snvs = VCFFile(filename=filename)
+        elif extn == 'tsv':
+            snvs = TSVFileTable(filename=filename)
+        elif extn == 'xls':
+            snvs = XLSFileTable(filename=filename)
+        elif extn == 'xlsx':
+            snvs = XLSXFileTable(filename=filename)
+        elif extn == 'txt':
+            snvs = TXTFileTable(filename=filename, headers=snvheaders)
+        else:
+            raise RuntimeError("Unexpected SNV file extension: %s" % filename)
+
+        for h in snvheaders:
+            if h not in snvs.headers():
+                raise RuntimeError(
+                    "Required header: %s missing from SNV file %s" % (h, filename))
+
+        for h in snvs.headers():
+            if h in snvheaders:
+                continue
+            # if h not in extrasnvheaders:
+            #     extrasnvheaders.append(h)
+
+        for r in snvs:
+            chr = r[snvheaders[0]].strip()
+            snvchroms[filename].add(chr)
+            locus = int(r[snvheaders[1]].strip())
+            ref = r[snvheaders[2]].strip()
+            alt = r[snvheaders[3]].strip()
+            if r.get('INFO:INDEL'):
+                continue
+            if len(ref) != 1:
+                continue
+            if not re.search(r'^[ACGT](,[ACGT])*$', alt):
+                continue
+            # for h in r:
+            #     if r.get(h):
+            #         usedsnvheaders.add(h)
+            snvkey = (filename, chr, locus, ref, alt)
+            if snvkey not in snvdata:
+                snvdata[snvkey] = r
+
+        progress.update()
+    progress.done()
+
+    chrreg = ChromLabelRegistry()
+
+    for snvfile in snvchroms:
+        chrreg.add_labels(snvfile,snvchroms[snvfile])
+
+    snvdata1 = {}
+    for (sf, chr, locus, ref, alt), r in snvdata.iteritems():
+        chrom = chrreg.label2chrom(sf,chr)
+        assert(chrom)
+        snvkey = (chrom,locus,ref,alt)
+        if snvkey not in snvdata1:
+            snvdata1[snvkey] = (chrom,locus,ref,alt,r)
+
+    # CRAM files are decoded with the reference FASTA, if given
+    reference = opt.reference or None
+    setreference(reference, opt.refcache)
+    for bamfile in opt.alignments:
+        chrreg.add_bamlabels(bamfile)
+
+    # Read counts are output for each alignment file or, with --groupby,
+    # each read group label of each alignment file
+    columnnames = []
+    for i, label in alignmentcolumns(opt.alignments, opt.groupby):
+        name = os.path.split(opt.alignments[i])[1].rsplit('.', 1)[0]
+        if label != None:
+            name += ":" + label
+        columnnames.append(name)
+
+    chrreg.determine_chrom_order()
+
+    snvdata = sorted(snvdata1.values(),key=lambda s: (chrreg.chrom_order(s[0]),s[1],s[2],s[3]))
+    # extrasnvheaders = filter(lambda h: h in usedsnvheaders, extrasnvheaders)
+    progress.message("SNVs: %d\n" % len(snvdata))
+
+    nsnvs = len(snvdata)
+
+    if opt.filter:
+        readfilter = SNVPileupReadFilter()
     else:
-        raise RuntimeError("Unexpected SNV file extension: %s" % filename)
-
-    for h in snvheaders:
-        if h not in snvs.headers():
-            raise RuntimeError(
-                "Required header: %s missing from SNV file %s" % (h, filename))
-
-    for h in snvs.headers():
-        if h in snvheaders:
-            continue
-        # if h not in extrasnvheaders:
-        #     extrasnvheaders.append(h)
-
-    for r in snvs:
-        chr = r[snvheaders[0]].strip()
-	snvchroms[filename].add(chr)
-        locus = int(r[snvheaders[1]].strip())
-        ref = r[snvheaders[2]].strip()
-        alt = r[snvheaders[3]].strip()
-        if r.get('INFO:INDEL'):
-            continue
-        if len(ref) != 1:
-            continue
-        if not re.search(r'^[ACGT](,[ACGT])*$', alt):
-            continue
-        # for h in r:
-        #     if r.get(h):
-        #         usedsnvheaders.add(h)
-        snvkey = (filename, chr, locus, ref, alt)
-        if snvkey not in snvdata:
-            snvdata[snvkey] = r
-
-    progress.update()
-progress.done()
-
-chrreg = ChromLabelRegistry()
-
-for snvfile in snvchroms:
-    chrreg.add_labels(snvfile,snvchroms[snvfile])
-
-snvdata1 = {}
-for (sf, chr, locus, ref, alt), r in snvdata.iteritems():
-    chrom = chrreg.label2chrom(sf,chr)
-    assert(chrom)
-    snvkey = (chrom,locus,ref,alt)
-    if snvkey not in snvdata1:
-        snvdata1[snvkey] = (chrom,locus,ref,alt,r)
-
-for bamfile in opt.alignments:
-    chrreg.add_bamlabels(bamfile)
-
-chrreg.determine_chrom_order()
-
-snvdata = sorted(snvdata1.values(),key=lambda s: (chrreg.chrom_order(s[0]),s[1],s[2],s[3]))
-# extrasnvheaders = filter(lambda h: h in usedsnvheaders, extrasnvheaders)
-progress.message("SNVs: %d\n" % len(snvdata))
+        readfilter = BasicFilter()
+
+    # Good reads per read count column to downsample to, estimated from
+    # all SNV loci, even for a shard. Percentile --maxreads values are
+    # taken from the good reads at a sample of the SNV loci, as the
+    # rescaling below, which --downsample replaces, takes them from the
+    # good reads at every output SNV locus. A column without sampled
+    # loci is not downsampled.
+    downsample = 0
+    if opt.downsample and opt.maxreads < 1e+20:
+        if opt.maxreads >= 1:
+            downsample = int(opt.maxreads)
+        else:
+            progress.stage("Estimate good read depth percentile")
+            downsample = []
+            for goodreads in lociGoodReads(snvdata, opt.alignments, readfilter, chrreg,
+                                           minreads=opt.minreads, unique=opt.unique,
+                                           maxdepth=opt.maxdepth, reference=reference,
+                                           groupby=opt.groupby):
+                if len(goodreads) == 0:
+                    downsample.append(0)
+                    continue
+                goodreads = sorted(goodreads)
+                downsample.append(max(1, goodreads[min(len(goodreads) - 1, int(round(len(goodreads) * opt.maxreads)))]))
+            progress.done()
+
+    if shard:
+        snvdata = snvdata[(shard[0] - 1) * nsnvs // shard[1]:shard[0] * nsnvs // shard[1]]
+        progress.message("Shard %d/%d SNVs: %d\n" % (shard[0], shard[1], len(snvdata)))
 
 outheaders = snvheaders + filter(None, """
 SNVCountForward
@@ -245,7 +386,9 @@ if not opt.full:
             outheaders1.remove(dh)
 
 emptysym = None
-if opt.output:
+if shard:
+    output = None
+elif opt.output:
     filename = opt.output
     base, extn = filename.rsplit('.', 1)
     extn = extn.lower()
@@ -267,213 +410,253 @@ else:
     output = TXTFileTable(filename=sys.stdout, headers=outheaders1)
     emptysym = "-"
 
-outrows = []
+if not opt.merge:
 
-# if opt.debug:
-#     import random
-#     random.seed(1234567)
-#     snvdata = sorted(random.sample(snvdata,10000))
-#     snvdata = sorted(sorted(random.sample(snvdata,200))*5)
-#     snvdata = sorted(random.sample(snvdata,200))*5
+    outrows = []
 
-if opt.filter:
-    readfilter = SNVPileupReadFilter()
-else:
-    readfilter = BasicFilter()
+    # if opt.debug:
+    #     import random
+    #     random.seed(1234567)
+    #     snvdata = sorted(random.sample(snvdata,10000))
+    #     snvdata = sorted(sorted(random.sample(snvdata,200))*5)
+    #     snvdata = sorted(random.sample(snvdata,200))*5
 
-if opt.tpb == 0:
-    pileups = SerialPileups(snvdata, opt.alignments, readfilter, chrreg).iterator()
-else:
-    pileups = MultiprocPileups(snvdata, opt.alignments, readfilter, chrreg, procsperbam=opt.tpb).iterator()
+    # Alignment files open at once, each with its own decompression threads
+    if opt.shards > 0:
+        openfiles = opt.shards * len(opt.alignments)
+    else:
+        openfiles = max(1, opt.tpb) * len(opt.alignments)
+    bgzfthreads = decompressionthreads(opt.bgzfthreads, openfiles)
+
+    # Loci at which an alignment file's coverage bounds (see CoverageBins)
+    # rule out --minreads good reads are dropped before any pileup.
+    if opt.prescreen and opt.minreads > 0:
+        progress.stage("Pre-screen SNV loci by coverage", len(opt.alignments))
+        for bamfile in opt.alignments:
+            bins = CoverageBins(bamfile, threads=bgzfthreads)
+            chrommap = chrreg.chrommap(bamfile)
+            snvdata = filter(lambda s: bins.bound(chrommap(s[0]), s[1] - 1) >= opt.minreads, snvdata)
+            bins.save()
+            progress.update()
+        progress.done()
+        progress.message("Pre-screened SNVs: %d\n" % len(snvdata))
+
+    if opt.shards > 0:
+        pileups = ShardedPileups(snvdata, opt.alignments, readfilter, chrreg,
+                                 processes=opt.shards, shardby=opt.shardby,
+                                 window=opt.window, unique=opt.unique, fetch=opt.fetch,
+                                 downsample=downsample, maxdepth=opt.maxdepth, threads=bgzfthreads, reference=reference,
+                                 fileorder=opt.fileorder, minreads=opt.minreads, groupby=opt.groupby).countsiterator()
+    elif opt.tpb == 0 and opt.prefetch > 0:
+        pileups = PrefetchPileups(snvdata, opt.alignments, readfilter, chrreg,
+                                  prefetch=opt.prefetch, readahead=1024*opt.readahead,
+                                  window=opt.window, unique=opt.unique, fetch=opt.fetch,
+                                  downsample=downsample, maxdepth=opt.maxdepth, threads=bgzfthreads, reference=reference,
+                                  fileorder=opt.fileorder, minreads=opt.minreads, groupby=opt.groupby).countsiterator()
+    elif opt.tpb == 0 and opt.fetch:
+        pileups = FetchPileups(snvdata, opt.alignments, readfilter, chrreg,
+                               window=opt.window, unique=opt.unique,
+                               downsample=downsample, threads=bgzfthreads, reference=reference,
+                               fileorder=opt.fileorder, minreads=opt.minreads, groupby=opt.groupby).countsiterator()
+    elif opt.tpb == 0 and opt.window > 0:
+        pileups = WindowedPileups(snvdata, opt.alignments, readfilter, chrreg,
+                                  window=opt.window, unique=opt.unique,
+                                  downsample=downsample, maxdepth=opt.maxdepth, threads=bgzfthreads, reference=reference,
+                                  fileorder=opt.fileorder, minreads=opt.minreads, groupby=opt.groupby).countsiterator()
+    elif opt.tpb == 0:
+        pileups = SerialPileups(snvdata, opt.alignments, readfilter, chrreg,
+                                unique=opt.unique,
+                                downsample=downsample, maxdepth=opt.maxdepth, threads=bgzfthreads, reference=reference,
+                                fileorder=opt.fileorder, minreads=opt.minreads, groupby=opt.groupby).countsiterator()
+    else:
+        pileups = MultiprocPileups(snvdata, opt.alignments, readfilter, chrreg,
+                                   procsperbam=opt.tpb, window=opt.window, unique=opt.unique, fetch=opt.fetch,
+                                   downsample=downsample, maxdepth=opt.maxdepth, threads=bgzfthreads, reference=reference,
+                                   fileorder=opt.fileorder, minreads=opt.minreads, groupby=opt.groupby,
+                                   countsonly=True).countsiterator()
+
+    progress.stage("Count reads per SNV", len(snvdata))
+
+    totalsnvs = 0
+    start = time.time()
+    # for i in range(len(snvdata)):
+    for snvchr, snvpos, ref, alt, snvextra in snvdata:
+    
+    ##     if opt.debug:
+    ##      if totalsnvs % 100 == 0 and totalsnvs > 0:
+    ##          print "SNVs/sec: %.2f"%(float(totalsnvs)/(time.time()-start),)
+
+        # Good reads are counted by base, strand and alignment file, after
+        # removing duplicate reads (based on the read sequence) if requested.
+        snvchr1, snvpos1, ref1, alt1, total, counts, badread, duplicates_removed = pileups.next()
+        assert(snvchr == snvchr1 and snvpos == snvpos1)
+    
+        if opt.debug:
+             print snvchr,snvpos,ref,alt, \
+                 " ".join(map(str,map(lambda i: total[i],range(len(columnnames))))), \
+                 " ".join(map(str,map(lambda i: badread[(i, 'Good')],range(len(columnnames)))))
+
+        totalsnvs += 1
+
+        mincounted = 1e+20
+        for si, colname in enumerate(columnnames):
+            counted = sum(map(lambda t: counts[(t[0], t[1], si)], [
+                          (n, d) for n in 'ACGT' for d in 'FR']))
+            mincounted = min(counted, mincounted)
+        if mincounted < opt.minreads:
+            continue
 
-progress.stage("Count reads per SNV", len(snvdata))
+        for si, colname in enumerate(columnnames):
+            nsnvf = sum(map(lambda nuc: counts[(nuc, "F", si)], map(str.strip,alt.split(','))))
+            nsnvr = sum(map(lambda nuc: counts[(nuc, "R", si)], map(str.strip,alt.split(','))))
+            nsnv = nsnvr + nsnvf
+            nreff = counts[(ref, "F", si)]
+            nrefr = counts[(ref, "R", si)]
+            nref = nreff + nrefr
+            othernucs = set('ACGT') - set([ref] + alt.split(','))
+            notherf = sum(map(lambda nuc: counts[(nuc, "F", si)], othernucs))
+            notherr = sum(map(lambda nuc: counts[(nuc, "R", si)], othernucs))
+            nother = notherf + notherr
+            counted = sum(map(lambda t: counts[(t[0], t[1], si)], [
+                          (n, d) for n in 'ACGT' for d in 'FR']))
+
+            row = [ snvchr, snvpos, ref, alt ] + \
+                  [ colname ] + \
+                  [nsnvf, nsnvr,
+                   nreff, nrefr,
+                   nsnv, nref,
+                   counted,
+                   100.0 * (total[si] - badread[si, 'Good']) /
+                   float(total[si]) if total[si] != 0 else 0.0,
+                   float(nsnv)/(nsnv+nref),
+                   -1, -1, -1, -1, -1,
+                   notherf, notherr,
+                   nother,
+                   -1, -1, -1, -1, -1,
+                   -1, -1, -1, -1, -1,
+                   duplicates_removed[si],
+                   badread[si, 'Good'],
+                   total[si]]
+
+            for s in sorted(BadRead.allheaders):
+                row.append(badread[si, s])
+            outrows.append(row)
+
+        progress.update()
+    progress.done()
+    if not opt.quiet:
+        print "SNVs/sec: %.2f"%(float(totalsnvs)/(time.time()-start),)
+
+    if shard:
+        # Raw counts only, p-values and FDR need every row and any
+        # percentile --maxreads scaling, see --merge.
+        progress.stage('Output shard partial read counts')
+        # Shards merge only if counted with the same options that change
+        # the read counts. The pileup engine and --prescreen, which only
+        # drops loci --minreads drops anyway, do not, except that --fetch
+        # ignores --maxdepth.
+        partial = dict(format=PARTIALFORMAT, shard=shard[0], shards=shard[1],
+                       snvs=nsnvs, outheaders=outheaders,
+                       alignments=columnnames,
+                       options=(opt.minreads, opt.filter, opt.unique,
+                                downsample, opt.maxdepth, opt.fetch,
+                                opt.groupby),
+                       rows=outrows)
+        wh = open(opt.output, 'wb')
+        cPickle.dump(partial, wh, cPickle.HIGHEST_PROTOCOL)
+        wh.close()
+        progress.done()
+        sys.exit(0)
 
-totalsnvs = 0
-start = time.time()
-# for i in range(len(snvdata)):
-for snvchr, snvpos, ref, alt, snvextra in snvdata:
-    
-##     if opt.debug:
-## 	if totalsnvs % 100 == 0 and totalsnvs > 0:
-## 	    print "SNVs/sec: %.2f"%(float(totalsnvs)/(time.time()-start),)
+else:
 
-    snvchr1, snvpos1, ref1, alt1, total, reads, badread = pileups.next()
-    assert(snvchr == snvchr1 and snvpos == snvpos1)
-    
-    if opt.debug:
-         print snvchr,snvpos,ref,alt, \
-             " ".join(map(str,map(lambda i: total[i],range(len(opt.alignments))))), \
-             " ".join(map(str,map(lambda i: badread[(i, 'Good')],range(len(opt.alignments)))))
-
-    goodreads = defaultdict(list)
-    for al, pos, base, si in reads:
-        goodreads[base].append((si, al))
-
-    # Deduplicate the reads based on the read sequence or the
-    # start and end of the alignment or ???
-    duplicates_removed = Counter()
-    if opt.unique:
-        for base in goodreads:
-            seen = set()
-            retain = list()
-            for si, al in goodreads[base]:
-                if (si, al.seq) not in seen:
-                    retain.append((si, al))
-                    seen.add((si, al.seq))
-                else:
-                    duplicates_removed[si] += 1
-            goodreads[base] = retain
-
-    # goodreads now contains the relevant read alignments.
-
-    totalsnvs += 1
-
-    counts = defaultdict(int)
-    for base in goodreads:
-        for si, al in goodreads[base]:
-            counts[(base, "R" if al.is_reverse else "F", si)] += 1
-    mincounted = 1e+20
-    for si, alf in enumerate(opt.alignments):
-        counted = sum(map(lambda t: counts[(t[0], t[1], si)], [
-                      (n, d) for n in 'ACGT' for d in 'FR']))
-        mincounted = min(counted, mincounted)
-    if mincounted < opt.minreads:
-        continue
-
-    for si, alf in enumerate(opt.alignments):
-        nsnvf = sum(map(lambda nuc: counts[(nuc, "F", si)], map(str.strip,alt.split(','))))
-        nsnvr = sum(map(lambda nuc: counts[(nuc, "R", si)], map(str.strip,alt.split(','))))
-        nsnv = nsnvr + nsnvf
-        nreff = counts[(ref, "F", si)]
-        nrefr = counts[(ref, "R", si)]
-        nref = nreff + nrefr
-        othernucs = set('ACGT') - set([ref] + alt.split(','))
-        notherf = sum(map(lambda nuc: counts[(nuc, "F", si)], othernucs))
-        notherr = sum(map(lambda nuc: counts[(nuc, "R", si)], othernucs))
-        nother = notherf + notherr
-        counted = sum(map(lambda t: counts[(t[0], t[1], si)], [
-                      (n, d) for n in 'ACGT' for d in 'FR']))
-
-        row = [ snvchr, snvpos, ref, alt ] + \
-              [ os.path.split(alf)[1].rsplit('.', 1)[0] ] + \
-              [nsnvf, nsnvr,
-               nreff, nrefr,
-               nsnv, nref,
-               counted,
-               100.0 * (total[si] - badread[si, 'Good']) /
-               float(total[si]) if total[si] != 0 else 0.0,
-	       float(nsnv)/(nsnv+nref),
-               -1, -1, -1, -1, -1,
-               notherf, notherr,
-               nother,
-	       -1, -1, -1, -1, -1,
-               -1, -1, -1, -1, -1,
-               duplicates_removed[si],
-               badread[si, 'Good'],
-               total[si]]
-
-        for s in sorted(BadRead.allheaders):
-            row.append(badread[si, s])
-        outrows.append(row)
-
-    progress.update()
-progress.done()
-if not opt.quiet:
-    print "SNVs/sec: %.2f"%(float(totalsnvs)/(time.time()-start),)
+    outrows, options = readpartials(opt.merge)
+    downsample = options[3]
 
-# Determine the maxreads value, if percentile, otherwise let the defaultdict take care of it
+# Determine the maxreads value, if percentile, otherwise let the defaultdict take care of it.
+# Read counts downsampled by the pileup engines are not scaled again.
 coverage = defaultdict(list)
 maxreads = defaultdict(lambda: int(opt.maxreads))
-if 0 < opt.maxreads < 1:
-    for r in map(lambda r: dict(zip(outheaders,r)),outrows):
-	coverage[r['AlignedReads']].append(r['GoodReads'])
+if downsample:
+    maxreads = defaultdict(lambda: 1e+20)
+elif 0 < opt.maxreads < 1:
+    pos = outheaders.index('AlignedReads')
+    pos1 = outheaders.index('GoodReads')
+    for r in outrows:
+	coverage[r[pos]].append(r[pos1])
     for al in coverage:
 	n = len(coverage[al])
 	percind = int(round(n*opt.maxreads))
 	maxreads[al] = sorted(coverage[al])[percind]
 
-for i in range(len(outrows)):
-
-    #Exctract the counts and rescale if necessary
-    r = dict(zip(outheaders, outrows[i]))
-    al,nsnv,nref,nother,counted = map(r.get,["AlignedReads","SNVCount","RefCount","OtherCount","GoodReads"])
-    if counted > maxreads[al]:
-	factor = float(maxreads[al])/float(counted)
-	nsnv = int(round(factor*nsnv))
-	nref = int(round(factor*nref))
-	nother = int(round(factor*nother))
-
-    #Compute p-values
-    pcount = 0.5
-    n = nsnv + nref + nother
-    nprime = nsnv + nref + nother + 4 * pcount
-    q = float(nother + 2 * pcount) / (2 * nprime)
-    nothomoref = binom_test_high(nsnv, n, q)
-    nothomovar = binom_test_high(nref, n, q)
-    if nsnv > nref:
-        nothet = binom_test_high(nsnv, nsnv + nref, 0.5)
-        refdom = 1.0
-        vardom = nothet
-    elif nref > nsnv:
-        nothet = binom_test_high(nref, nsnv + nref, 0.5)
-        vardom = 1.0
-        refdom = nothet
-    else:
-        nothet = 1.0
-        vardom = 1.0
-        refdom = 1.0
-
-    # And store in the output rows...
-    pos = outheaders.index("NotHomoRefpV")
-    outrows[i][pos] = nothomoref
-    pos = outheaders.index("NotHetpV")
-    outrows[i][pos] = nothet
-    pos = outheaders.index("NotHomoVarpV")
-    outrows[i][pos] = nothomovar
-    pos = outheaders.index("VarDompV")
-    outrows[i][pos] = vardom
-    pos = outheaders.index("RefDompV")
-    outrows[i][pos] = refdom
+# The rows are scored as arrays, one entry per row
+def countsarray(h):
+    pos = outheaders.index(h)
+    return numpy.fromiter((r[pos] for r in outrows), dtype=numpy.int64, count=len(outrows))
+
+def setcolumn(h, values):
+    pos = outheaders.index(h)
+    if isinstance(values, numpy.ndarray):
+        values = values.tolist()
+    for r, v in izip(outrows, values):
+        r[pos] = v
+
+# Extract the counts and rescale if necessary, rounding halves up as
+# round does
+nsnv, nref, nother, counted = map(countsarray, ["SNVCount", "RefCount", "OtherCount", "GoodReads"])
+pos = outheaders.index("AlignedReads")
+rowmaxreads = numpy.array([float(maxreads[r[pos]]) for r in outrows], dtype=float)
+rescale = counted > rowmaxreads
+factor = rowmaxreads[rescale] / counted[rescale]
+for counts in (nsnv, nref, nother):
+    scaled = factor * counts[rescale]
+    rounded = numpy.floor(scaled)
+    counts[rescale] = rounded + (scaled - rounded >= 0.5)
+
+# Compute p-values
+pcount = 0.5
+n = nsnv + nref + nother
+nprime = n + 4 * pcount
+q = (nother + 2 * pcount) / (2 * nprime)
+nothomoref = binom_test_high_batch(nsnv, n, q)
+nothomovar = binom_test_high_batch(nref, n, q)
+nothet = numpy.where(nsnv != nref, binom_test_high_batch(numpy.maximum(nsnv, nref), nsnv + nref, 0.5), 1.0)
+vardom = numpy.where(nsnv > nref, nothet, 1.0)
+refdom = numpy.where(nref > nsnv, nothet, 1.0)
+
+# And store in the output rows...
+setcolumn("NotHomoRefpV", nothomoref)
+setcolumn("NotHetpV", nothet)
+setcolumn("NotHomoVarpV", nothomovar)
+setcolumn("VarDompV", vardom)
+setcolumn("RefDompV", refdom)
 
 # Now compute FDR and scores...
 
 pvkeys = filter(lambda h: h.endswith('pV'), outheaders)
 fdrkeys = filter(lambda h: h.endswith('FDR'), outheaders)
-allpvals = []
+pvals = dict(NotHomoRefpV=nothomoref, NotHetpV=nothet, NotHomoVarpV=nothomovar,
+             VarDompV=vardom, RefDompV=refdom)
 n = len(outrows)
-for pvk in pvkeys:
-    pos = outheaders.index(pvk)
-    allpvals.extend(map(itemgetter(pos), outrows))
-# print allpvals
-allfdrs = fdr(allpvals)
+allfdrs = numpy.concatenate([pvals[pvk] for pvk in pvkeys])
+capped = numpy.empty(len(allfdrs), dtype=bool)
+fdr_array(allfdrs, out=allfdrs, capped=capped)
 
+fdrs = dict()
 for j, fdrk in enumerate(fdrkeys):
-    pos1 = outheaders.index(fdrk)
-    for i in range(len(outrows)):
-        outrows[i][pos1] = allfdrs[(j * n) + i]
-
-for i in range(len(outrows)):
-    r = dict(zip(outheaders, outrows[i]))
-    homovarsc = max(0.0, min(pvscore(r["NotHetFDR"]), pvscore(
-        r["NotHomoRefFDR"])) - pvscore(r["NotHomoVarFDR"]))
-    homorefsc = max(0.0, min(pvscore(r["NotHetFDR"]), pvscore(
-        r["NotHomoVarFDR"])) - pvscore(r["NotHomoRefFDR"]))
-    hetsc = max(0.0, min(pvscore(r["NotHomoRefFDR"]), pvscore(
-        r["NotHomoVarFDR"])) - pvscore(r["NotHetFDR"]))
-    vardomsc = pvscore(r["VarDomFDR"])
-    refdomsc = pvscore(r["RefDomFDR"])
-    pos = outheaders.index("HomoVarSc")
-    outrows[i][pos] = homovarsc
-    pos = outheaders.index("HomoRefSc")
-    outrows[i][pos] = homorefsc
-    pos = outheaders.index("HetSc")
-    outrows[i][pos] = hetsc
-    pos = outheaders.index("VarDomSc")
-    outrows[i][pos] = vardomsc
-    pos = outheaders.index("RefDomSc")
-    outrows[i][pos] = refdomsc
+    fdrs[fdrk] = allfdrs[(j * n):((j + 1) * n)]
+    setcolumn(fdrk, cappedlist(fdrs[fdrk], capped[(j * n):((j + 1) * n)]))
+
+nothetsc = pvscore_batch(fdrs["NotHetFDR"])
+nothomorefsc = pvscore_batch(fdrs["NotHomoRefFDR"])
+nothomovarsc = pvscore_batch(fdrs["NotHomoVarFDR"])
+setcolumn("HomoVarSc", numpy.maximum(0.0, numpy.minimum(nothetsc, nothomorefsc) - nothomovarsc))
+setcolumn("HomoRefSc", numpy.maximum(0.0, numpy.minimum(nothetsc, nothomovarsc) - nothomorefsc))
+setcolumn("HetSc", numpy.maximum(0.0, numpy.minimum(nothomorefsc, nothomovarsc) - nothetsc))
+setcolumn("VarDomSc", pvscore_batch(fdrs["VarDomFDR"]))
+setcolumn("RefDomSc", pvscore_batch(fdrs["RefDomFDR"]))
 
 progress.stage('Output results')
 output.from_rows(
-    map(lambda r: dict(zip(outheaders, r + [emptysym] * 50)), outrows))
+    (dict(zip(outheaders, r + [emptysym] * 50)) for r in outrows))
 progress.done()
@@ -174,8 +174,12 @@ else:
     emptysym = "-"
 
 outrows = []
-pvalues = []
-from fisher import fisher_exact, bonferroni, fdr, lod
+from fisher import fisher_exact_list, bonferroni, fdr, lod
+import numpy
+# Fisher exact test tables, (x, N, n, M), of the rows with a P-Value,
+# tested in one batch once all rows are made.
+tables = []
+testedrows = []
 progress.stage("Compute statistics")
 for (snpstr, junc), r in sorted(countdata.iteritems()):
     nsnpi = r.get('SNPJuncIntronCount', 0)
@@ -186,6 +190,7 @@ for (snpstr, junc), r in sorted(countdata.iteritems()):
     p = emptysym
     pval = emptysym
     lodval = emptysym
+    tested = False
     if junc and \
        (nsnpi + nsnpex) > 0 and \
        (nwti + nwtex) > 0 and \
@@ -195,12 +200,11 @@ for (snpstr, junc), r in sorted(countdata.iteritems()):
         pwt = nwti / float(nwti + nwtex)
         p = psnp / float(psnp + pwt)
 
-        pval = fisher_exact(nsnpi,
-                            (nsnpi + nsnpex),
-                            (nsnpi + nwti),
-                            (nsnpi + nsnpex + nwti + nwtex))
-
-        pvalues.append(pval)
+        tables.append((nsnpi,
+                       (nsnpi + nsnpex),
+                       (nsnpi + nwti),
+                       (nsnpi + nsnpex + nwti + nwtex)))
+        tested = True
 
         l = lod(nsnpi, (nsnpi + nsnpex), (nsnpi + nwti),
                 (nsnpi + nsnpex + nwti + nwtex))
@@ -213,6 +217,12 @@ for (snpstr, junc), r in sorted(countdata.iteritems()):
 
     row = dict(r.iteritems())
     outrows.append(row)
+    if tested:
+        testedrows.append(row)
+
+pvalues = fisher_exact_list(*numpy.array(tables, dtype=numpy.int64).reshape(-1, 4).T)
+for r, pval in zip(testedrows, pvalues):
+    r['P-Value'] = pval
 
 bonf = bonferroni(pvalues)
 fdr = fdr(pvalues)
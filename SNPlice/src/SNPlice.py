@@ -65,9 +65,9 @@ parser.add_option("-j", "--junctions", type="files", dest="junctions", default=N
                   notNone=True, remember=True,
                   filetypes=[("Splice Junctions (BED Format)", "*.bed")])
 parser.add_option("-r", "--readalignments", type="files", dest="alignments", default=None,
-                  help="Read alignments in BAM/SAM format. Required.", name="Read Alignments",
+                  help="Read alignments in BAM/CRAM/SAM format. Required.", name="Read Alignments",
                   notNone=True, remember=True,
-                  filetypes=[("Read Alignments (BAM/SAM Format)", "*.bam;*.sam")])
+                  filetypes=[("Read Alignments (BAM/CRAM/SAM Format)", "*.bam;*.cram;*.sam")])
 advanced.add_option("-d", "--distance", type="int", dest="dist", default=50, remember=True,
                     help="Upper bound on the distance between SNP locus and splice junction. Default: 50.",
                     name="Distance Bound")
@@ -82,6 +82,15 @@ advanced.add_option("-f", "--alignmentfilter", action="store_false", dest="filte
                     help="(Turn off) alignment filtering by length, edits, etc.", name="Filter Alignments")
 advanced.add_option("-U", "--uniquereads", action="store_true", dest="unique", default=False, remember=True,
                     help="Consider only distinct reads.", name="Unique Reads")
+advanced.add_option("--decompressthreads", type="int", dest="bgzfthreads", default=0, remember=True,
+                    help="htslib decompression threads for each open alignment file, if supported by pysam. Indicate no decompression threads with 0, or one thread per available CPU, shared between the open alignment files, with -1. Default=0.", name="Decompression Threads")
+advanced.add_option("--reference", type="file", dest="reference", default="", remember=True,
+                    help="Reference sequence FASTA file for decoding CRAM read alignments. Default=htslib reference lookup by MD5 checksum.", name="CRAM Reference",
+                    filetypes=[("Reference Sequence (FASTA)", "*.fa;*.fasta;*.fna")])
+advanced.add_option("--refcache", type="savedir", dest="refcache", default="", remember=True,
+                    help="Local directory caching reference sequences htslib looks up by MD5 checksum for CRAM read alignments. Default=htslib default (REF_CACHE).", name="CRAM Reference Cache")
+advanced.add_option("--approxdepth", type="int", dest="approxdepth", default=0, remember=True,
+                    help="Replace exact binomial and Fisher exact tests on at least this many reads by saddle-point approximations, within 0.02 of the exact scores (-10log10 p-value). Indicate exact tests with 0. Default=0.", name="Approx. Stats Depth")
 advanced.add_option("-q", "--quiet", action="store_true", dest="quiet", default=False, remember=True,
                     help="Quiet.", name="Quiet")
 parser.add_option("-o", "--output", type="savefile", dest="output", remember=True,
@@ -108,7 +117,7 @@ if not opt.output:
     opt.quiet = True
 progress = ProgressText(quiet=opt.quiet)
 
-import pysam
+from pysamimport import pysam, openalignments, decompressionthreads, setreference
 from dataset import XLSFileTable, CSVFileTable, TSVFileTable, XLSXFileTable, TXTFileTable, BEDFile, VCFFile
 
 progress.stage("Read SNP data", len(opt.snps))
@@ -193,11 +202,15 @@ juncdata = sorted((chr, gap[i], gap) for i in (0, 1) for chr, gap in juncdata)
 progress.message("Exon/Intron junctions: %d" % len(juncdata))
 
 samfiles = []
+setreference(opt.reference or None, opt.refcache)
+bgzfthreads = decompressionthreads(opt.bgzfthreads, len(opt.alignments))
 for al in opt.alignments:
     if al.lower().endswith('.bam'):
-        samfile = pysam.Samfile(al, "rb")
+        samfile = openalignments(al, "rb", threads=bgzfthreads, index=False)
+    elif al.lower().endswith('.cram'):
+        samfile = openalignments(al, "rc", threads=bgzfthreads, index=False)
     elif al.lower().endswith('.sam'):
-        samfile = pysam.Samfile(al, "r")
+        samfile = openalignments(al, "r", index=False)
     else:
         raise RuntimeError("Unexpected alignments file extension: %s." % al)
     samfiles.append(samfile)
@@ -278,8 +291,13 @@ outrows = []
 
 # at this point we need to merge the two lists of loci.
 # for simplicity, for now, lets just do a nested loop.
-from fisher import fisher_exact, bonferroni, fdr, lod
-pvalues = []
+from fisher import fisher_exact_list, bonferroni, fdr, lod, setapproxdepth
+setapproxdepth(opt.approxdepth)
+import numpy
+# Fisher exact test tables, (x, N, n, M), of the rows with a P-Value,
+# tested in one batch once all rows are made.
+tables = []
+testedrows = []
 if opt.filter:
     alifilter = SNPPileupReadFilter(maxsegments=2)
     matefilter = ReadFilter(maxsegments=2)
@@ -424,6 +442,7 @@ for snpchr, snppos, ref, alt, snpextra in snpdata:
         p = emptysym
         pval = emptysym
         lodval = emptysym
+        tested = False
         if (nsnpi + nsnpex) > 0 and \
            (nwti + nwtex) > 0 and \
            (nsnpi + nwti) > 0:
@@ -432,12 +451,11 @@ for snpchr, snppos, ref, alt, snpextra in snpdata:
             pwt = nwti / float(nwti + nwtex)
             p = psnp / (psnp + pwt)
 
-            pval = fisher_exact(nsnpi,
-                                (nsnpi + nsnpex),
-                                (nsnpi + nwti),
-                                (nsnpi + nsnpex + nwti + nwtex))
-
-            pvalues.append(pval)
+            tables.append((nsnpi,
+                           (nsnpi + nsnpex),
+                           (nsnpi + nwti),
+                           (nsnpi + nsnpex + nwti + nwtex)))
+            tested = True
 
             l = lod(nsnpi, (nsnpi + nsnpex), (nsnpi + nwti),
                     (nsnpi + nsnpex + nwti + nwtex))
@@ -472,6 +490,8 @@ for snpchr, snppos, ref, alt, snpextra in snpdata:
         for s in sorted(BadRead.allheaders):
             row.append(badread[s])
         outrows.append(row)
+        if tested:
+            testedrows.append(row)
 
     if not any:
 
@@ -484,11 +504,15 @@ for snpchr, snppos, ref, alt, snpextra in snpdata:
 progress.done()
 
 progress.stage('Multiple-test correction and FDR computation')
+pvalpos = outheaders.index('P-Value')
+pvalues = fisher_exact_list(*numpy.array(tables, dtype=numpy.int64).reshape(-1, 4).T)
+for r, pval in zip(testedrows, pvalues):
+    r[pvalpos] = pval
+
 bonf = bonferroni(pvalues)
 fdr = fdr(pvalues)
 
 i = 0
-pvalpos = outheaders.index('P-Value')
 for r in outrows:
     if len(r) > pvalpos:
         if r[pvalpos] != emptysym:
@@ -1,5 +1,5 @@
 
-from pysamimport import pysam
+from pysamimport import openalignments
 import re, sys
 from collections import defaultdict
 
@@ -80,8 +80,7 @@ class ChromLabelRegistry(object):
         self._reg[filename] = ChromLabels(labels)
 
     def add_bamlabels(self,filename):
-        samfile = pysam.Samfile(filename, "rb")
-	assert samfile._hasIndex(), "Cannot open BAM index for file %s"%filename
+        samfile = openalignments(filename)
 	self._reg[filename] = ChromLabels(samfile.references)
         self._bam.append(filename)
 
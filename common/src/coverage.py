@@ -0,0 +1,107 @@
+import os, os.path
+import numpy
+from pysamimport import openalignments
+from util import BAM_DEF_MASK
+
+class CoverageBins(object):
+    # Upper bounds on the read depth of an indexed alignment file, for
+    # each reference and binsize bases: the number of reads not flagged
+    # unmapped, secondary, QC fail or duplicate that overlap the bin. No
+    # read with a base aligned at a position in the bin, counted by a
+    # filter that skips those flags, is missed.
+    # A bin is counted from the index (one seek, reads counted by htslib)
+    # only when first queried, so only the references and regions of the
+    # loci asked about are ever read. Counted bins are cached next to the
+    # file (filename.cov.npz, UNCOUNTED marks the rest) by save, the cache
+    # is dropped when the file changes.
+    VERSION = 2
+    UNCOUNTED = numpy.iinfo(numpy.uint32).max
+    def __init__(self,filename,binsize=1024,cache=True,threads=0):
+        self.filename = filename
+        self.binsize = binsize
+        self.cache = cache
+        self.threads = threads
+        self.samfile = None
+        self.lengths = None
+        self.bins = dict()
+        self.counted = 0
+        st = os.stat(filename)
+        self.stamp = numpy.array([self.VERSION,binsize,BAM_DEF_MASK,st.st_size,int(st.st_mtime)],dtype=numpy.int64)
+        if cache:
+            self.bins = self.load()
+
+    @staticmethod
+    def cachefile(filename):
+        return filename + '.cov.npz'
+
+    def load(self):
+        try:
+            data = numpy.load(self.cachefile(self.filename))
+        except (IOError, OSError, ValueError):
+            return dict()
+        if not numpy.array_equal(data['stamp'],self.stamp):
+            return dict()
+        names = list(data['names'])
+        return dict((str(names[j]),data['bins%d'%j]) for j in range(len(names)))
+
+    def save(self):
+        # Bins counted by concurrent runs on the same file (shards) since
+        # this one loaded the cache are merged in, and the cache is written
+        # to a temporary file and renamed, so no run sees a partial cache.
+        # An unwritable directory just means no cache.
+        if not self.cache or self.counted == 0:
+            return
+        for label,bins in self.load().items():
+            if label not in self.bins:
+                self.bins[label] = bins
+            elif len(bins) == len(self.bins[label]):
+                mine = self.bins[label]
+                mine[mine == self.UNCOUNTED] = bins[mine == self.UNCOUNTED]
+        filename = self.cachefile(self.filename)
+        tmpfile = "%s.%d.tmp"%(filename,os.getpid())
+        names = sorted(self.bins)
+        arrays = dict(('bins%d'%j,self.bins[name]) for j,name in enumerate(names))
+        try:
+            wh = open(tmpfile,'wb')
+            numpy.savez_compressed(wh,stamp=self.stamp,names=numpy.array(names),**arrays)
+            wh.close()
+            os.rename(tmpfile,filename)
+            self.counted = 0
+        except (IOError, OSError):
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+
+    def open(self):
+        if self.samfile == None:
+            self.samfile = openalignments(self.filename,threads=self.threads)
+            self.lengths = dict(zip(self.samfile.references,self.samfile.lengths))
+
+    def count(self,label,b):
+        start = b*self.binsize
+        end = start + self.binsize
+        try:
+            return self.samfile.count(label,start,end,read_callback='all')
+        except TypeError:
+            # older pysam, no read_callback
+            return sum(1 for al in self.samfile.fetch(label,start,end) if not (al.flag & BAM_DEF_MASK))
+
+    def bound(self,label,pos):
+        # At most this many reads have a base aligned at (0-based) pos
+        if pos < 0:
+            return 0
+        bins = self.bins.get(label)
+        if bins is None:
+            self.open()
+            if label not in self.lengths:
+                return 0
+            bins = numpy.empty(self.lengths[label]//self.binsize + 1,dtype=numpy.uint32)
+            bins.fill(self.UNCOUNTED)
+            self.bins[label] = bins
+        b = pos//self.binsize
+        if b >= len(bins):
+            return 0
+        if bins[b] == self.UNCOUNTED:
+            self.open()
+            bins[b] = self.count(label,b)
+            self.counted += 1
+        return int(bins[b])
@@ -1,26 +1,124 @@
+import sys
 import numpy
 from scipy.stats.distributions import hypergeom, binom
-from math import log
+from scipy.special import gammaln, ndtr, xlogy
+from math import log, sqrt, pi
+
+# Results held by each memoized function
+MEMOSIZE = 100000
+
+# Separates keyword arguments from positional ones in memo keys
+_KEYWORDS = object()
+
+
+class Memoized(object):
+    # Bounded memo cache of a function's results, with hit, miss and
+    # eviction counts for memoreport. Not an exact LRU cache but a
+    # two-generation approximation of one: results are held in two
+    # generations of at most maxsize/2 each, those used since the older
+    # generation was started are kept, the rest are evicted together
+    # once the newer one is full, however recently they were used
+    # before that.
+    caches = []
+
+    def __init__(self, f, maxsize=None):
+        self.f = f
+        self.__name__ = f.__name__
+        self.maxsize = maxsize or MEMOSIZE
+        self.recent = dict()
+        self.old = dict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        Memoized.caches.append(self)
+
+    def __call__(self, *args, **kw):
+        key = args
+        if kw:
+            key = args + (_KEYWORDS,) + tuple(sorted(kw.iteritems()))
+        try:
+            value = self.recent[key]
+            self.hits += 1
+            return value
+        except KeyError:
+            pass
+        try:
+            value = self.old.pop(key)
+            self.hits += 1
+        except KeyError:
+            value = self.f(*args, **kw)
+            self.misses += 1
+        if len(self.recent) >= self.maxsize // 2:
+            self.evictions += len(self.old)
+            self.old = self.recent
+            self.recent = dict()
+        self.recent[key] = value
+        return value
+
+    def __len__(self):
+        return len(self.recent) + len(self.old)
+
+    def clear(self):
+        self.recent = dict()
+        self.old = dict()
 
 
 def memoize(f):
-    cache = {}
+    return Memoized(f)
+
+
+def memoreport(out=sys.stderr):
+    # Cache statistics of the memoized functions that were called
+    for c in Memoized.caches:
+        if c.hits + c.misses > 0:
+            print >>out, "Memo cache %s: %d hits, %d misses, %d evictions, %d held" % \
+                (c.__name__, c.hits, c.misses, c.evictions, len(c))
+    # binom_test_high at p=0.5 from the table, the rest are counted by
+    # the _binom_test_high cache
+    if binomhalfhits > 0:
+        print >>out, "Memo table binom_test_high(p=0.5): %d hits, %d held" % \
+            (binomhalfhits, len(binomhalftable()))
 
-    def decorated_function(*args, **kw):
-        key = (args, tuple(sorted(kw.iteritems())))
-        if key not in cache:
-            cache[key] = f(*args, **kw)
-        return cache[key]
-    return decorated_function
+
+# binom_test_high(n, N, 0.5), for integral n and N up to BINOMHALFMAXN,
+# from a table built on first use, with row N from index N(N + 1)/2.
+# Lookups are counted in binomhalfhits for memoreport.
+BINOMHALFMAXN = 1000
+binomhalfhits = 0
+_binomhalf = dict()
+
+
+def binomhalftable(maxN=None):
+    # The table for N up to maxN, BINOMHALFMAXN if not given
+    if maxN == None:
+        maxN = BINOMHALFMAXN
+    if maxN not in _binomhalf:
+        N = numpy.repeat(numpy.arange(maxN + 1), numpy.arange(1, maxN + 2))
+        n = numpy.arange(len(N)) - N * (N + 1) // 2
+        _binomhalf[maxN] = numpy.where(n == 0, 1.0, numpy.clip(binom.sf(n - 1, N, 0.5), 0.0, 1.0))
+    return _binomhalf[maxN]
 
 
 @memoize
 def binom_test_low(n, N, p):
+    if APPROXDEPTH > 0 and N >= APPROXDEPTH:
+        return float(binom_test_low_batch(n, N, p))
     return binom.cdf(n, N, p)
 
 
-@memoize
 def binom_test_high(n, N, p):
+    global binomhalfhits
+    if p == 0.5 and 0 <= n <= N <= BINOMHALFMAXN and n == int(n) and N == int(N):
+        binomhalfhits += 1
+        n, N = int(n), int(N)
+        return float(binomhalftable()[N * (N + 1) // 2 + n])
+    return _binom_test_high(n, N, p)
+
+
+@memoize
+def _binom_test_high(n, N, p):
+    if APPROXDEPTH > 0 and N >= APPROXDEPTH:
+        return float(binom_test_high_batch(n, N, p))
     if n == 0:
         return 1.0
     return min(max(0.0, binom.sf(n - 1, N, p)), 1.0)
@@ -42,6 +140,12 @@ def pvscore(x):
     return max(0.0, -10.0 * log(x, 10.0))
 
 
+def pvscore_batch(x):
+    # pvscore for an array of p-values, log(x, 10) as in math.log
+    x = numpy.maximum(numpy.asarray(x, dtype=float), 1e-10)
+    return numpy.maximum(0.0, -10.0 * (numpy.log(x) / log(10.0)))
+
+
 @memoize
 def lod(x, N, n, M, pseudocount=0.5, base=2.0):
     n00 = x
@@ -60,12 +164,16 @@ def lod(x, N, n, M, pseudocount=0.5, base=2.0):
 
 @memoize
 def fisher_exact_high(x, N, n, M):
+    if APPROXDEPTH > 0 and M >= APPROXDEPTH:
+        return float(fisher_exact_high_batch(x, N, n, M))
     return min(1, max(0, sum(hypergeom.pmf(x1, M, n, N) for x1 in range(x, N + 1))))
     # return min(1,max(0,hypergeom.sf(x-1,M,n,n)))
 
 
 @memoize
 def fisher_exact_low(x, N, n, M):
+    if APPROXDEPTH > 0 and M >= APPROXDEPTH:
+        return float(fisher_exact_low_batch(x, N, n, M))
     return min(1, max(0, sum(hypergeom.pmf(x1, M, n, N) for x1 in range(0, x + 1))))
     # return min(1,max(0,hypergeom.cdf(x,M,n,N)))
 
@@ -79,21 +187,348 @@ def fisher_exact(x, N, n, M, direction=None):
     return min(fisher_exact_low(x, N, n, M), fisher_exact_high(x, N, n, M))
 
 
+# Batch versions of the exact tests, for arrays of counts. The binomial
+# tests are one vectorized scipy call over the arrays, which is faster
+# than summing their tails from the log factorial table below and gives
+# the scalar tests' p-values exactly. The hypergeometric tails are
+# summed in log space from a table of log factorials, from the end
+# nearest the mode, where the terms are largest, out into the tail,
+# or as one minus the other tail when x is on the other side of the
+# mode, until the terms drop below TAILEPS of the first. They agree
+# with the scalar tests to about 1e-10 relative.
+
+TAILEPS = 1e-20
+TAILCHUNK = 64
+TAILROWS = 16384
+
+# log(k!) for k = 0, 1, ..., len - 1, grown as needed by logfactorial
+_logfactorials = gammaln(numpy.arange(1024) + 1.0)
+
+
+def logfactorial(k):
+    global _logfactorials
+    k = numpy.asarray(k, dtype=numpy.int64)
+    if k.size > 0 and k.max() >= len(_logfactorials):
+        n = max(2 * len(_logfactorials), int(k.max()) + 1)
+        _logfactorials = gammaln(numpy.arange(n) + 1.0)
+    return _logfactorials[k]
+
+
+def hypergeom_logpmf(k, N, n, M):
+    # k of N draws without replacement hit the n of M
+    return logfactorial(n) - logfactorial(k) - logfactorial(n - k) + \
+        logfactorial(M - n) - logfactorial(N - k) - logfactorial(M - n - N + k) - \
+        logfactorial(M) + logfactorial(N) + logfactorial(M - N)
+
+
+def logtail(logpmf, start, stop, step, args):
+    # Log of the sum of the pmf terms from start to stop (inclusive), in
+    # the direction step (+1 or -1), for 1-d arrays of start, stop and
+    # step and the pmf's args. Terms must not increase away from start.
+    # Empty sums are -inf. Summed TAILCHUNK terms at a time, for at most
+    # TAILROWS sums at once.
+    result = numpy.full(len(start), -numpy.inf)
+    first = numpy.full(len(start), -numpy.inf)
+    nonempty = numpy.flatnonzero((stop - start) * step >= 0)
+    first[nonempty] = logpmf(start[nonempty], *[a[nonempty] for a in args])
+    nonempty = nonempty[numpy.isfinite(first[nonempty])]
+    total = numpy.zeros(len(start))
+    for b in range(0, len(nonempty), TAILROWS):
+        active = nonempty[b:b + TAILROWS]
+        offset = 0
+        while len(active) > 0:
+            k = start[active, None] + step[active, None] * numpy.arange(offset, offset + TAILCHUNK)
+            valid = (stop[active, None] - k) * step[active, None] >= 0
+            k = numpy.where(valid, k, start[active, None])
+            terms = logpmf(k, *[a[active, None] for a in args])
+            terms = numpy.where(valid, numpy.exp(terms - first[active, None]), 0.0)
+            total[active] += terms.sum(axis=1)
+            done = ~valid[:, -1] | (terms[:, -1] < TAILEPS)
+            active = active[~done]
+            offset += TAILCHUNK
+    result[nonempty] = first[nonempty] + numpy.log(total[nonempty])
+    return result
+
+
+def tails(logpmf, x, lo, hi, mode, args, high):
+    # P(X >= x) if high, else P(X <= x), for X with support lo..hi and
+    # the given mode, from the tail beyond x, or one minus the other
+    # tail, whichever lies beyond the mode.
+    x = numpy.clip(x, lo - 1, hi + 1)
+    pv = numpy.empty(len(x))
+    if high:
+        direct = x >= mode
+        ends = (x, hi, 1), (x - 1, lo, -1)
+    else:
+        direct = x <= mode
+        ends = (x, lo, -1), (x + 1, hi, 1)
+    for sel, (start, stop, step), complement in ((direct, ends[0], False), (~direct, ends[1], True)):
+        sel = numpy.flatnonzero(sel)
+        lt = logtail(logpmf, start[sel], stop[sel], numpy.full(len(sel), step, dtype=numpy.int64),
+                     [a[sel] for a in args])
+        pv[sel] = -numpy.expm1(lt) if complement else numpy.exp(lt)
+    return numpy.clip(pv, 0.0, 1.0)
+
+
+# Fast statistics: with APPROXDEPTH > 0, the tails of binomial
+# distributions of at least APPROXDEPTH trials (N), and hypergeometric
+# distributions of at least APPROXDEPTH in all (M), are approximated by
+# the Lugannani-Rice saddle-point formula with the second continuity
+# correction. Skovgaard's double saddle-point approximation is used
+# for the hypergeometric. Tails of distributions with variance below
+# APPROXVAR, or summed exactly in TAILCHUNK terms or fewer, stay
+# exact. Checked against the exact tests for p from 1e-5 to 0.5, N
+# from 100 to 1e5 and 2x2 tables with M up to 1e5, the approximate
+# p-values are within 0.4% relative, or 0.02 in pvscore, of the
+# exact ones.
+
+APPROXDEPTH = 0
+APPROXVAR = 4.0
+
+
+def setapproxdepth(depth):
+    # Memoized results computed the other way are dropped
+    global APPROXDEPTH
+    if depth != APPROXDEPTH:
+        for c in Memoized.caches:
+            c.clear()
+    APPROXDEPTH = depth
+
+
+def lugannani_rice(w, u, skew):
+    # Upper tail probability from the signed root of the likelihood
+    # ratio statistic w and u. Close to the mean, where 1/w - 1/u
+    # cancels, its limit skew is used instead.
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        d = numpy.where(numpy.abs(w) < 1e-2, skew, 1 / w - 1 / u)
+    return ndtr(-w) - numpy.exp(-w * w / 2) / sqrt(2 * pi) * d
+
+
+def binom_saddlepoint(y, N, p):
+    # P(X >= y), X binomial, for y above the mean
+    yt = y - 0.5
+    p1 = yt / N
+    s = numpy.log(p1 / (1 - p1)) - numpy.log(p / (1 - p))
+    w = numpy.sign(s) * numpy.sqrt(2 * numpy.maximum(0.0, xlogy(yt, p1 / p) + xlogy(N - yt, (1 - p1) / (1 - p))))
+    v = N * p1 * (1 - p1)
+    return lugannani_rice(w, 2 * numpy.sinh(s / 2) * numpy.sqrt(v), (1 - 2 * p1) / (6 * numpy.sqrt(v)))
+
+
+def hypergeom_saddlepoint(y, N, n, M):
+    # P(X >= y), y of N draws hit the n of M, for y above the mean, as
+    # the first row of a 2x2 table of two binomials conditioned on the
+    # column total.
+    yt = y - 0.5
+    p1 = yt / N
+    p2 = (n - yt) / (M - N)
+    p0 = n / M
+    s = numpy.log(p1 / (1 - p1)) - numpy.log(p2 / (1 - p2))
+    ll = xlogy(yt, p1) + xlogy(N - yt, 1 - p1) + xlogy(n - yt, p2) + xlogy(M - N - n + yt, 1 - p2) - \
+        xlogy(n, p0) - xlogy(M - n, 1 - p0)
+    w = numpy.sign(s) * numpy.sqrt(2 * numpy.maximum(0.0, ll))
+    v1 = N * p1 * (1 - p1)
+    v2 = (M - N) * p2 * (1 - p2)
+    v = v1 * v2 / (v1 + v2)
+    skew = v ** 1.5 * ((1 - 2 * p1) / v1 ** 2 - (1 - 2 * p2) / v2 ** 2) / 6
+    return lugannani_rice(w, 2 * numpy.sinh(s / 2) * numpy.sqrt(v1 * v2 / (M * p0 * (1 - p0))), skew)
+
+
+def binom_approx(y, N, p):
+    # Where P(X >= y), X binomial, is approximated, and its value there
+    y, N, p = [numpy.asarray(a, dtype=numpy.float64) for a in (y, N, p)]
+    above = y - 0.5 > N * p
+    terms = numpy.where(above, N - y + 1, y)
+    approx = (N >= APPROXDEPTH) & (N * p * (1 - p) >= APPROXVAR) & (0 < y) & (y <= N) & (terms > TAILCHUNK)
+    y, N, p, above = y[approx], N[approx], p[approx], above[approx]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        pv = numpy.where(above, binom_saddlepoint(y, N, p), 1 - binom_saddlepoint(N - y + 1, N, 1 - p))
+    return approx, numpy.clip(pv, 0.0, 1.0)
+
+
+def hypergeom_approx(y, N, n, M):
+    # Where P(X >= y), y of N draws hit the n of M, is approximated, and
+    # its value there
+    y, N, n, M = [numpy.asarray(a, dtype=numpy.float64) for a in (y, N, n, M)]
+    lo = numpy.maximum(0, N - (M - n))
+    hi = numpy.minimum(n, N)
+    above = y - 0.5 > N * n / M
+    terms = numpy.where(above, hi - y + 1, y - lo)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        var = N * n * (M - n) * (M - N) / (M * M * (M - 1))
+    approx = (M >= APPROXDEPTH) & (var >= APPROXVAR) & (lo < y) & (y <= hi) & (terms > TAILCHUNK)
+    y, N, n, M, above = y[approx], N[approx], n[approx], M[approx], above[approx]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        pv = numpy.where(above, hypergeom_saddlepoint(y, N, n, M),
+                         1 - hypergeom_saddlepoint(N - y + 1, N, M - n, M))
+    return approx, numpy.clip(pv, 0.0, 1.0)
+
+
+def binom_test_low_batch(n, N, p):
+    # binom_test_low for arrays of n, N and p, P(X <= n) as P(N - X >=
+    # N - n) when approximated.
+    n, N, p = numpy.broadcast_arrays(numpy.asarray(n), numpy.asarray(N), numpy.asarray(p, dtype=numpy.float64))
+    pv = numpy.empty(n.shape)
+    rest = numpy.ones(n.shape, dtype=bool)
+    if APPROXDEPTH > 0:
+        approx, approxpv = binom_approx(N - n, N, 1 - p)
+        pv[approx] = approxpv
+        rest = ~approx
+    if rest.any():
+        pv[rest] = binom.cdf(n[rest], N[rest], p[rest])
+    return pv
+
+
+def binom_test_high_batch(n, N, p):
+    # binom_test_high for arrays of n, N and p
+    global binomhalfhits
+    half = numpy.isscalar(p) and p == 0.5
+    n, N, p = numpy.broadcast_arrays(numpy.asarray(n), numpy.asarray(N), numpy.asarray(p, dtype=numpy.float64))
+    pv = numpy.empty(n.shape)
+    rest = numpy.ones(n.shape, dtype=bool)
+    if half:
+        intable = (N <= BINOMHALFMAXN) & (0 <= n) & (n <= N) & (n == numpy.floor(n)) & (N == numpy.floor(N))
+        Nt = N[intable].astype(numpy.int64)
+        pv[intable] = binomhalftable()[Nt * (Nt + 1) // 2 + n[intable].astype(numpy.int64)]
+        binomhalfhits += len(Nt)
+        rest = ~intable
+    if APPROXDEPTH > 0 and rest.any():
+        approx, approxpv = binom_approx(n[rest], N[rest], p[rest])
+        sel = numpy.flatnonzero(rest)[approx]
+        pv.flat[sel] = approxpv
+        rest.flat[sel] = False
+    if rest.any():
+        pv[rest] = numpy.where(n[rest] == 0, 1.0, numpy.clip(binom.sf(n[rest] - 1, N[rest], p[rest]), 0.0, 1.0))
+    return pv
+
+
+def binom_test_batch(n, N, p, direction=None):
+    if direction in ('high', 1):
+        return binom_test_high_batch(n, N, p)
+    elif direction in ('low', -1):
+        return binom_test_low_batch(n, N, p)
+    return numpy.minimum(binom_test_low_batch(n, N, p), binom_test_high_batch(n, N, p))
+
+
+def hypergeom_arrays(x, N, n, M):
+    x, N, n, M = numpy.broadcast_arrays(*[numpy.asarray(a, dtype=numpy.int64) for a in (x, N, n, M)])
+    lo = numpy.maximum(0, N - (M - n)).ravel()
+    hi = numpy.minimum(n, N).ravel()
+    mode = (N + 1) * (n + 1) // (M + 2)
+    return x.ravel(), lo, hi, mode.ravel(), (N.ravel(), n.ravel(), M.ravel()), x.shape
+
+
+def hypergeom_tails(x, N, n, M, high):
+    # fisher_exact_high, or low, for arrays of x, N, n and M, P(X <= x)
+    # as P(N - X >= N - x), N - X of the N draws hitting the M - n, when
+    # approximated.
+    x, lo, hi, mode, (N, n, M), shape = hypergeom_arrays(x, N, n, M)
+    pv = numpy.empty(len(x))
+    rest = numpy.ones(len(x), dtype=bool)
+    if APPROXDEPTH > 0:
+        if high:
+            approx, approxpv = hypergeom_approx(x, N, n, M)
+        else:
+            approx, approxpv = hypergeom_approx(N - x, N, M - n, M)
+        pv[approx] = approxpv
+        rest = ~approx
+    rest = numpy.flatnonzero(rest)
+    pv[rest] = tails(hypergeom_logpmf, x[rest], lo[rest], hi[rest], mode[rest],
+                     (N[rest], n[rest], M[rest]), high)
+    return pv.reshape(shape)
+
+
+def fisher_exact_high_batch(x, N, n, M):
+    # fisher_exact_high for arrays of x, N, n and M
+    return hypergeom_tails(x, N, n, M, True)
+
+
+def fisher_exact_low_batch(x, N, n, M):
+    # fisher_exact_low for arrays of x, N, n and M
+    return hypergeom_tails(x, N, n, M, False)
+
+
+def fisher_exact_batch(x, N, n, M, direction=None):
+    if direction in ('high', 1):
+        return fisher_exact_high_batch(x, N, n, M)
+    elif direction in ('low', -1):
+        return fisher_exact_low_batch(x, N, n, M)
+    return numpy.minimum(fisher_exact_low_batch(x, N, n, M), fisher_exact_high_batch(x, N, n, M))
+
+
+# fisher_exact_list leaves p-values within CAPEPS of 1, or below
+# TINYPV, to fisher_exact itself.
+CAPEPS = 1e-9
+TINYPV = 1e-290
+
+
+def fisher_exact_list(x, N, n, M, direction=None):
+    # fisher_exact for arrays of x, N, n and M, as a list of the values
+    # fisher_exact returns. Its tails are capped at the int 1, or are the
+    # int 0, where their sums reach 1, or are 0, which only it can tell;
+    # p-values of the batch tests close to 1 or 0 are replaced by its
+    # own.
+    x, N, n, M = [numpy.asarray(a, dtype=numpy.int64).ravel() for a in (x, N, n, M)]
+    pvs = fisher_exact_batch(x, N, n, M, direction)
+    values = pvs.tolist()
+    for i in numpy.flatnonzero((pvs >= 1.0 - CAPEPS) | (pvs < TINYPV)):
+        values[i] = fisher_exact(int(x[i]), int(N[i]), int(n[i]), int(M[i]), direction)
+    return values
+
+
+def cappedlist(values, capped):
+    # values as a list, with those at capped (a boolean array) the int 1
+    # rather than 1.0, as min(x, 1) gives for x > 1.
+    values = values.tolist()
+    for i in numpy.flatnonzero(capped):
+        values[i] = 1
+    return values
+
+
 def bonferroni(pvs):
-    n = len(pvs)
-    return map(lambda pv: min(n * pv, 1), pvs)
+    capped = numpy.empty(len(pvs), dtype=bool)
+    return cappedlist(bonferroni_array(pvs, capped=capped), capped)
+
+
+def bonferroni_array(pvs, out=None, capped=None):
+    # Bonferroni corrected p-values of an array of p-values, as float64,
+    # into out if given (which may be the p-values array itself). capped,
+    # if given, is set where the corrected p-value was capped at 1.
+    pvs = numpy.asarray(pvs, dtype=numpy.float64)
+    out = numpy.multiply(pvs, len(pvs), out=out)
+    if capped is not None:
+        numpy.greater(out, 1.0, out=capped)
+    return numpy.minimum(out, 1.0, out=out)
 
 
 def fdr(pvs):
+    capped = numpy.empty(len(pvs), dtype=bool)
+    return cappedlist(fdr_array(pvs, capped=capped), capped)
+
+
+def fdr_array(pvs, out=None, capped=None):
+    # Benjamini-Hochberg FDR of an array of p-values, as float64, into
+    # out if given (which may be the p-values array itself). Tied
+    # p-values are ranked in array order, by a stable sort. capped, if
+    # given, is set where the FDR is 1 from a rank-scaled p-value capped
+    # at 1.
+    pvs = numpy.asarray(pvs, dtype=numpy.float64)
     n = len(pvs)
-    ind = sorted(range(n), key=lambda i: pvs[i])
-    fdr = [-1.0] * n
-    for i in range(n):
-        fdr[ind[i]] = min(pvs[ind[i]] * n / (i + 1), 1)
+    ind = numpy.argsort(pvs, kind='mergesort')
+    fdr = pvs[ind]
+    fdr *= n
+    fdr /= numpy.arange(1, n + 1, dtype=numpy.float64)
+    if capped is not None:
+        over = (fdr > 1.0)
+    numpy.minimum(fdr, 1.0, out=fdr)
     if n > 2:
-        for i in range(n - 2, -1, -1):
-            fdr[ind[i]] = min(fdr[ind[i]], fdr[ind[i + 1]])
-    return fdr
+        numpy.minimum.accumulate(fdr[::-1], out=fdr[::-1])
+    if capped is not None:
+        over &= (fdr == 1.0)
+        capped[ind] = over
+    if out is None:
+        out = numpy.empty(n, dtype=numpy.float64)
+    out[ind] = fdr
+    return out
 
 if __name__ == '__main__':
     import sys
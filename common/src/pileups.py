@@ -1,192 +1,1181 @@
 
 import threading
 import multiprocessing
+import ctypes
+import numpy
 from collections import Counter, namedtuple
-from pysamimport import pysam
-from util import BadRead
+from pysamimport import openalignments, BASECOUNTS, PILEUP_FILTERS
+from util import READREASONS, GOOD, GapAtSNV, reasoncounts, readpositions, \
+                 BAM_FPAIRED, BAM_FPROPER_PAIR, BAM_FMUNMAP, BAM_DEF_MASK
 import Queue
 import time, math, sys
+import heapq
+import zlib
+import struct
+import os.path
+
+# Fixed layout of the per-locus, per-column read counts shipped by
+# counts-only workers: locus index, column, total reads, good read counts
+# by base and strand, read counts by filter outcome and removed
+# duplicates.
+BASESTRANDS = [ (base, strand) for base in 'ACGTN' for strand in 'FR' ]
+BASESTRANDINDEX = dict((bs, j) for j, bs in enumerate(BASESTRANDS))
+COUNTSLOCUS = 0
+COUNTSCOLUMN = 1
+COUNTSTOTAL = 2
+COUNTSBASESTRAND = 3
+COUNTSREASON = COUNTSBASESTRAND + len(BASESTRANDS)
+COUNTSDUPLICATES = COUNTSREASON + len(READREASONS)
+COUNTSWIDTH = COUNTSDUPLICATES + 1
+
+def readcounts(reads,unique=False):
+    # Good read counts keyed by (base, strand, column), with reads of
+    # identical sequence optionally counted only once. The read filters
+    # have decoded, and pysam cached, the query sequence of good reads.
+    counts = Counter()
+    duplicates = Counter()
+    seen = set()
+    for al, pos, base, si in reads:
+        if unique:
+            key = (si, base, al.query_sequence)
+            if key in seen:
+                duplicates[si] += 1
+                continue
+            seen.add(key)
+        counts[(base, "R" if al.is_reverse else "F", si)] += 1
+    return counts, duplicates
+
+def readgroup(al):
+    # Read group (RG tag) of an alignment, None if it has none
+    try:
+        if hasattr(al,'get_tag'):
+            return al.get_tag('RG')
+        return al.opt('RG')
+    except KeyError:
+        return None
+
+def readgroups(samfile,groupby):
+    # Labels of the read groups (@RG header lines) of an alignment file
+    # by their groupby field (ID, SM, LB, ...), in header order, and the
+    # label of each read group ID. Read groups without the field are
+    # labelled by their ID.
+    header = samfile.header
+    if hasattr(header,'to_dict'):
+        header = header.to_dict()
+    labels = []
+    rglabels = dict()
+    for rg in header.get('RG',[]):
+        label = rg.get(groupby,rg['ID'])
+        if label not in labels:
+            labels.append(label)
+        rglabels[rg['ID']] = label
+    return labels, rglabels
+
+def alignmentcolumns(filenames,groupby=None):
+    # The read count columns: (alignment file index, label) for each
+    # read group label of each alignment file, with groupby, or label
+    # None for a whole alignment file.
+    columns = []
+    for i,filename in enumerate(filenames):
+        labels = []
+        if groupby:
+            labels, rglabels = readgroups(openalignments(filename,index=False),groupby)
+        if len(labels) == 0:
+            labels = [None]
+        for label in labels:
+            columns.append((i,label))
+    return columns
+
+def readorder(pileupread):
+    # Reproducible pseudo-random order of reads, across runs and
+    # processes, from a hash of the read name.
+    return zlib.crc32(pileupread.alignment.qname) & 0xffffffff
+
+def lociGoodReads(loci,samfiles,filter,chrreg,nsample=200,minreads=0,**kw):
+    # Good reads in each column (see alignmentcolumns) at up to nsample
+    # loci evenly spaced through the (sorted) loci, piled up without
+    # downsampling. Only loci with at least minreads good reads, less
+    # any removed duplicates, in every column are kept, as readCounts
+    # outputs. Further keyword arguments are passed to SerialPileups.
+    step = max(1,len(loci)//nsample)
+    kw['downsample'] = 0
+    pileups = SerialPileups(loci[::step],samfiles,filter,chrreg,minreads=minreads,**kw)
+    goodreads = [ [] for column in pileups.columns ]
+    for snvchr, snvpos, ref, alt, total, counts, cnts, duplicates in pileups.countsiterator():
+        counted = [ sum(counts[(n, d, j)] for n in 'ACGT' for d in 'FR') for j in range(len(goodreads)) ]
+        if min(counted) < minreads:
+            continue
+        for j in range(len(goodreads)):
+            goodreads[j].append(cnts[(j, 'Good')])
+    return goodreads
+
+def addreasons(cnts,reasons):
+    # Add the reason counts arrays of the columns of an alignment file,
+    # keyed by column, to the read counts keyed by (column, reason).
+    for i, ireasons in reasons.iteritems():
+        for code, n in enumerate(ireasons):
+            if n > 0:
+                cnts[(i, READREASONS[code])] += n
+
+def packcounts(row,l,i,total,counts,reasons,duplicates):
+    # The counts of column i, reasons its reason counts array
+    row[COUNTSLOCUS] = l
+    row[COUNTSCOLUMN] = i
+    row[COUNTSTOTAL] = total[i]
+    for (base, strand, si), n in counts.iteritems():
+        if si == i:
+            row[COUNTSBASESTRAND + BASESTRANDINDEX.get((base, strand), BASESTRANDINDEX[('N', strand)])] += n
+    row[COUNTSREASON:COUNTSDUPLICATES] = reasons
+    row[COUNTSDUPLICATES] = duplicates[i]
+
+def unpackcounts(row,total,counts,cnts,duplicates):
+    i = int(row[COUNTSCOLUMN])
+    total[i] += int(row[COUNTSTOTAL])
+    for j, (base, strand) in enumerate(BASESTRANDS):
+        if row[COUNTSBASESTRAND + j] > 0:
+            counts[(base, strand, i)] += int(row[COUNTSBASESTRAND + j])
+    for j, reason in enumerate(READREASONS):
+        if row[COUNTSREASON + j] > 0:
+            cnts[(i, reason)] += int(row[COUNTSREASON + j])
+    if row[COUNTSDUPLICATES] > 0:
+        duplicates[i] += int(row[COUNTSDUPLICATES])
+
+class BAMIndex(object):
+    # The linear index of a BAM index (.bai) file: for each reference and
+    # 16kb window, the smallest virtual file offset of the reads that
+    # overlap it.
+    def __init__(self,filename):
+        data = open(filename,'rb').read()
+        assert data[:4] == 'BAI\1', "Bad BAM index file %s"%filename
+        nref, = struct.unpack_from('<i',data,4)
+        offset = 8
+        self.intervals = []
+        for tid in range(nref):
+            nbin, = struct.unpack_from('<i',data,offset)
+            offset += 4
+            for b in range(nbin):
+                bin, nchunk = struct.unpack_from('<Ii',data,offset)
+                offset += 8 + 16*nchunk
+            nintv, = struct.unpack_from('<i',data,offset)
+            offset += 4
+            self.intervals.append(numpy.frombuffer(data,dtype='<u8',count=nintv,offset=offset))
+            offset += 8*nintv
+
+    @staticmethod
+    def filename(bamfile):
+        if os.path.exists(bamfile + '.bai'):
+            return bamfile + '.bai'
+        return bamfile[:-4] + '.bai'
+
+    def voffset(self,tid,pos):
+        # Virtual file offset from which reads overlapping pos are found,
+        # None if no reads are indexed there.
+        if tid < 0 or tid >= len(self.intervals):
+            return None
+        intervals = self.intervals[tid]
+        if (pos >> 14) >= len(intervals):
+            return None
+        return int(intervals[pos >> 14])
+
+# Stands in for a pysam PileupRead, for reads attributed to loci by
+# fetchpileups.
+FetchedRead = namedtuple('FetchedRead',['alignment','query_position','indel','is_del'])
+
+# Base quality below which pileups leave a read out of a column's reads,
+# but not its depth, see pysamimport.PILEUP_FILTERS. fetchpileups does the
+# same, and also skips orphan mates and adjusts the base qualities of
+# overlapping mates (see MateOverlaps) as the pileup does.
+MINBASEQUALITY = (13 if PILEUP_FILTERS else 0)
+
+def pileupquality(pileupread):
+    # Base quality of a pysam PileupRead, of the next base in a gap, with
+    # the pileup's adjustments for overlapping mates
+    quals = pileupread.alignment.query_qualities
+    if quals == None:
+        return 255
+    qpos = pileupread.query_position_or_next
+    return (quals[qpos] if qpos < len(quals) else 0)
+
+class MateOverlaps(object):
+    # Base qualities of fetched reads as htslib's pileup sees them. Reads
+    # are pushed in file order and a properly paired read is matched with
+    # its mate, if still overlapping; where both mates cover a position
+    # with a base, a base agreeing with the mate's gets the sum of their
+    # qualities (at most 200) in the first mate and none in the second,
+    # otherwise the mate with the higher quality keeps 0.8 of it and the
+    # other none.
+    def __init__(self):
+        self.unmatched = dict()
+        self.mates = dict()
+        self.first = set()
+
+    def push(self,al):
+        flag = al.flag
+        if not (flag & BAM_FPAIRED) or (flag & BAM_FMUNMAP):
+            return
+        if not (flag & BAM_FPROPER_PAIR) or abs(al.tlen) >= 2*al.rlen:
+            return
+        mate = self.unmatched.get(al.qname)
+        if mate != None and mate.aend <= al.pos:
+            del self.unmatched[al.qname]
+            mate = None
+        if mate == None:
+            self.unmatched[al.qname] = al
+            return
+        del self.unmatched[al.qname]
+        self.mates[id(mate)] = al
+        self.mates[id(al)] = mate
+        self.first.add(id(mate))
+
+    def quality(self,read,pos):
+        # Base quality of FetchedRead read at (0-based) position pos
+        al = read.alignment
+        qpos = read.query_position
+        quals = al.query_qualities
+        if quals == None:
+            return 255
+        q = (quals[qpos] if qpos < len(quals) else 0)
+        mate = self.mates.get(id(al))
+        if mate == None or read.is_del:
+            return q
+        for mpos, mqpos, mdeleted, mindel in readpositions(mate,[pos]):
+            mquals = mate.query_qualities
+            if mdeleted or mquals == None:
+                return q
+            mq = mquals[mqpos]
+            first = (id(al) in self.first)
+            if al.query_sequence[qpos] == mate.query_sequence[mqpos]:
+                return (min(200, q + mq) if first else 0)
+            if (q >= mq) if first else (q > mq):
+                return int(0.8*q)
+            return 0
+        return q
+
+# The sequence and strand of good reads, as needed by readcounts, shipped
+# by worker processes in place of pysam reads. Reads counted from their
+# base in the pileup column share one per strand.
+PileupAlignment = namedtuple('PileupAlignment',['query_sequence','is_reverse'])
+BASEALIGNMENTS = (PileupAlignment(None,False), PileupAlignment(None,True))
+
+class VerdictCache(object):
+    # Locus independent read filter verdicts for one alignment file, keyed
+    # by read identity, for reads that cover more than one locus. Pileup
+    # columns must be visited in position order on each chromosome; reads
+    # are dropped once the columns pass their reference end, or in order
+    # of reference end once more than maxsize reads are held.
+    def __init__(self,maxsize=100000):
+        self.maxsize = maxsize
+        self.clear()
+
+    def clear(self):
+        self._verdicts = dict()
+        self._ends = []
+        self._tid = None
+
+    def sweep(self,tid,pos):
+        if tid != self._tid:
+            self.clear()
+            self._tid = tid
+        while len(self._ends) > 0 and self._ends[0][0] <= pos:
+            self._evict()
+
+    def _evict(self):
+        end, key = heapq.heappop(self._ends)
+        del self._verdicts[key]
+
+    def verdict(self,al,classify):
+        key = (al.qname, al.flag, al.pos)
+        try:
+            return self._verdicts[key]
+        except KeyError:
+            pass
+        result = classify(al)
+        if len(self._verdicts) >= self.maxsize:
+            self._evict()
+        self._verdicts[key] = result
+        heapq.heappush(self._ends, (al.aend, key))
+        return result
 
 class Pileups(object):
-    def __init__(self,loci,samfiles,filter,chrreg):
+    def __init__(self,loci,samfiles,filter,chrreg,**kw):
         self.loci = loci
         self.samfiles = samfiles
         self.filter = filter
-	self.chrreg = chrreg
+        self.chrreg = chrreg
+        # Loci no more than window bases apart share a pileup iterator,
+        # 0 indicates one pileup iterator per locus.
+        self.window = kw.get('window',0)
+        self.unique = kw.get('unique',False)
+        # htslib decompression threads for each alignment file opened
+        self.threads = kw.get('threads',0)
+        # Reference sequence FASTA for CRAM alignment files, passed
+        # explicitly so worker processes need not inherit it
+        self.reference = kw.get('reference',None)
+        # Reads held in each alignment file's VerdictCache, 0 to turn
+        # off verdict caching.
+        self.verdicts = kw.get('verdicts',100000)
+        # Keyword arguments for samfile.pileup, which skips flagged reads
+        # (BAM_DEF_MASK) without counting them. Maximum reads per pileup
+        # column (pysam's default is 8000).
+        self.pileupargs = dict(max_depth=kw.get('maxdepth',8000))
+        # Good reads per column (see below) at each locus, when exceeded
+        # the reads are examined in readorder until this many are good and
+        # the rest are dropped. One value for all columns or a list, 0 for
+        # no downsampling.
+        self.downsample = kw.get('downsample',0)
+        # Attribute fetched reads to the loci of each window rather than
+        # pile up each locus, see fetchpileups.
+        self.fetch = kw.get('fetch',False)
+        if self.fetch and self.window <= 0:
+            self.window = 150
+        # Visit the windows of loci in each BAM file in ascending file
+        # offset order, from its .bai linear index, see offsetpileups.
+        self.fileorder = kw.get('fileorder',False)
+        self.indices = [None]*len(self.samfiles)
+        # readCounts drops loci at which any alignment file has fewer
+        # than minreads good reads, once one file is known to, the other
+        # files skip the locus. Flagged by the index of the first locus
+        # at each position, 0 for no skipping.
+        self.minreads = kw.get('minreads',0)
+        # Reads are counted in columns, one per alignment file or, with
+        # groupby, one per read group label of each alignment file (see
+        # alignmentcolumns). Reads of read groups not in the header are
+        # not counted. rgcolumns maps read group IDs to columns, None for
+        # alignment files counted as one column.
+        self.groupby = kw.get('groupby',None)
+        self.columns = alignmentcolumns(self.samfiles,self.groupby)
+        self.filecolumns = [ [] for al in self.samfiles ]
+        for j,(i,label) in enumerate(self.columns):
+            self.filecolumns[i].append(j)
+        self.rgcolumns = [None]*len(self.samfiles)
+        if self.groupby:
+            for i,al in enumerate(self.samfiles):
+                labels, rglabels = readgroups(openalignments(al,index=False),self.groupby)
+                if len(labels) > 0:
+                    column = dict((label,j) for j,(i1,label) in enumerate(self.columns) if i1 == i)
+                    self.rgcolumns[i] = dict((rgid,column[label]) for rgid,label in rglabels.iteritems())
+        # Reads with a base quality below MINBASEQUALITY at the locus are
+        # in the total but not classified. The pileup leaves them out of a
+        # column's reads, which cannot be told apart by read group from
+        # the column depth, so with read groups the pileup keeps them and
+        # columncounts drops them (see pileupquality).
+        self.qualitycut = (MINBASEQUALITY > 0 and self.rgcolumns.count(None) != len(self.rgcolumns))
+        if self.qualitycut:
+            self.pileupargs['min_base_quality'] = 0
+        if not isinstance(self.downsample,list):
+            self.downsample = [self.downsample]*len(self.columns)
+        # Reads of alignment file i are put in readorder if there are
+        # more than mindownsample[i], the least of its columns' limits.
+        self.mindownsample = [0]*len(self.samfiles)
+        for j,(i,label) in enumerate(self.columns):
+            if self.downsample[j] > 0 and (self.mindownsample[i] == 0 or self.downsample[j] < self.mindownsample[i]):
+                self.mindownsample[i] = self.downsample[j]
+        # Reads are counted from the bases of each pileup column, rather
+        # than classified one pysam read at a time, when the filter allows
+        # (see util.ReadClassifier.basecode) and neither read sequences,
+        # for unique, nor read names or groups are needed.
+        self.basecounts = kw.get('basecounts',True) and BASECOUNTS and filter.basecounts and \
+                          not self.unique and max(self.mindownsample) == 0 and \
+                          self.rgcolumns.count(None) == len(self.rgcolumns)
+        self.positions = dict()
+        self.belowmin = None
+        if self.minreads > 0:
+            for l,locus in enumerate(self.loci):
+                self.positions.setdefault(locus[:2],l)
+            self.belowmin = self.flags(len(self.loci))
+
+    def alignment(self,al):
+        return al
+
+    def flags(self,n):
+        return bytearray(n)
+
+    def minreadsorder(self):
+        # Indices of the alignment files in the order they are piled up at
+        # each locus. With minreads, the smallest (cheapest, least
+        # covered) alignment files come first.
+        order = range(len(self.samfiles))
+        if self.minreads > 0:
+            order.sort(key=lambda i: os.path.getsize(self.samfiles[i]))
+        return order
+
+    def skiplocus(self,snvchr,snvpos):
+        return self.minreads > 0 and self.belowmin[self.positions[snvchr,snvpos]] != 0
+
+    def checkminreads(self,snvchr,snvpos,result):
+        # Flag the locus for the other alignment files if a column of
+        # result has fewer than minreads good reads
+        if self.minreads > 0 and min(reasons[GOOD] for reasons in result[2].itervalues()) < self.minreads:
+            self.belowmin[self.positions[snvchr,snvpos]] = 1
+        return result
+
+    def windows(self,loci):
+        # Split the (sorted) loci into runs on the same chromosome with
+        # consecutive loci at most self.window bases apart.
+        run = []
+        for locus in loci:
+            if len(run) > 0 and (locus[0] != run[-1][0] or \
+                                 (locus[1] - run[-1][1]) > self.window):
+                yield run
+                run = []
+            run.append(locus)
+        if len(run) > 0:
+            yield run
+
+    def columncounts(self,i,pileupcolumn,verdicts=None):
+        if self.basecounts:
+            return self.basecolumncounts(i,pileupcolumn)
+        pileupreads = pileupcolumn.pileups
+        if self.qualitycut:
+            pileupreads, lowquality = self.qualityreads(i,pileupreads,pileupquality)
+        else:
+            lowquality = Counter({self.filecolumns[i][0]: pileupcolumn.n - len(pileupreads)})
+        return self.readscounts(i,pileupcolumn.tid,pileupcolumn.pos,
+                                pileupreads,verdicts,lowquality)
+
+    def qualityreads(self,i,pileupreads,quality):
+        # The reads of alignment file i with a base quality, from function
+        # quality, of at least MINBASEQUALITY and the number of the others
+        # by column.
+        column = self.readcolumn(i)
+        reads = []
+        lowquality = Counter()
+        for pileupread in pileupreads:
+            if quality(pileupread) >= MINBASEQUALITY:
+                reads.append(pileupread)
+                continue
+            j = column(pileupread.alignment)
+            if j != None:
+                lowquality[j] += 1
+        return reads, lowquality
+
+    def readscounts(self,i,tid,pos,pileupreads,verdicts=None,lowquality=None):
+        # Reads are classified without raising BadRead and counted by
+        # classification code (see util.READREASONS) in the columns of
+        # alignment file i. The total adds the lowquality reads, by
+        # column, left out of pileupreads for base quality. Reads left
+        # unexamined by downsampling, which applies to each column, and
+        # gaps at the locus are not in the total.
+        if verdicts != None:
+            verdicts.sweep(tid,pos)
+        if len(pileupreads) < self.minreads:
+            # Too few reads to have minreads good reads
+            return self.emptycounts(i)
+        total, reads, reasons = self.emptycounts(i)
+        classify = self.filter.classify
+        rgcolumns = self.rgcolumns[i]
+        j = self.filecolumns[i][0]
+        jreasons = reasons[j]
+        downsample = self.downsample[j]
+        if self.mindownsample[i] > 0 and len(pileupreads) > self.mindownsample[i]:
+            pileupreads = sorted(pileupreads,key=readorder)
+        for pileupread in pileupreads:
+            if rgcolumns != None:
+                j = rgcolumns.get(readgroup(pileupread.alignment))
+                if j == None:
+                    continue
+                jreasons = reasons[j]
+                downsample = self.downsample[j]
+            if downsample > 0 and jreasons[GOOD] >= downsample:
+                if rgcolumns == None:
+                    break
+                continue
+            code, result = classify(pileupread,verdicts)
+            jreasons[code] += 1
+            if code == GOOD:
+                al, pos, base, nseg = result
+                reads.append((self.alignment(al), pos, base, j))
+        for j,jreasons in reasons.iteritems():
+            total[j] = sum(jreasons) - jreasons[GapAtSNV.code]
+            if lowquality != None:
+                total[j] += lowquality[j]
+        return total, reads, reasons
+
+    def basecolumncounts(self,i,pileupcolumn):
+        # As readscounts, for the single column of alignment file i, but
+        # with the reads' base strings from the pileup column counted
+        # first and each distinct string classified once.
+        qseqs = pileupcolumn.get_query_sequences(mark_matches=False,mark_ends=False,add_indels=True)
+        if len(qseqs) < self.minreads:
+            return self.emptycounts(i)
+        total, reads, reasons = self.emptycounts(i)
+        basecode = self.filter.basecode
+        j = self.filecolumns[i][0]
+        jreasons = reasons[j]
+        for qseq, n in Counter(qseqs).iteritems():
+            code, result = basecode(qseq)
+            jreasons[code] += n
+            if code == GOOD:
+                base, reverse = result
+                reads.extend([(BASEALIGNMENTS[reverse], None, base, j)]*n)
+        total[j] = pileupcolumn.n - jreasons[GapAtSNV.code]
+        return total, reads, reasons
+
+    def emptycounts(self,i):
+        # No reads in the columns of alignment file i
+        total = Counter()
+        reasons = dict()
+        for j in self.filecolumns[i]:
+            total[j] = 0
+            reasons[j] = reasoncounts()
+        return total, [], reasons
+
+    def readcolumn(self,i):
+        # The column of a read of alignment file i, None if not counted
+        rgcolumns = self.rgcolumns[i]
+        if rgcolumns == None:
+            j = self.filecolumns[i][0]
+            return lambda al: j
+        return lambda al: rgcolumns.get(readgroup(al))
+
+    def locuspileups(self,i,samfile,chrommap,loci,verdicts=None):
+        # Generates (total, reads, reasons) for alignment file i at each
+        # of the loci, in order. Loci skipped for minreads are empty.
+        for snvchr, snvpos, ref, alt, snvextra in loci:
+            if self.skiplocus(snvchr, snvpos):
+                yield self.emptycounts(i)
+                continue
+            snvpos1 = snvpos - 1
+            result = None
+            try:
+                snvlabel = chrommap(snvchr)
+                if snvlabel != None:
+                    for pileupcolumn in samfile.pileup(snvlabel, snvpos1, snvpos1 + 1, truncate=True, **self.pileupargs):
+                        result = self.columncounts(i, pileupcolumn, verdicts)
+            except ValueError, e:
+                pass # raise e
+            if result == None:
+                result = self.emptycounts(i)
+            yield self.checkminreads(snvchr, snvpos, result)
+
+    def windowpileups(self,i,samfile,chrommap,loci,verdicts=None):
+        # As locuspileups, but one pileup iterator walks all the columns
+        # of each window rather than seeking to each locus separately.
+        for window in self.windows(loci):
+            columns = iter([])
+            try:
+                snvlabel = chrommap(window[0][0])
+                if snvlabel != None:
+                    columns = samfile.pileup(snvlabel, window[0][1] - 1, window[-1][1], truncate=True, **self.pileupargs)
+            except ValueError, e:
+                pass # raise e
+            positions = set(snvpos - 1 for snvchr, snvpos, ref, alt, snvextra in window)
+            colpos = -1
+            result = None
+            for snvchr, snvpos, ref, alt, snvextra in window:
+                snvpos1 = snvpos - 1
+                # Loci with more than one alternative allele share a
+                # column, the pileup reads are only valid until the
+                # iterator advances.
+                while colpos < snvpos1:
+                    result = None
+                    try:
+                        pileupcolumn = columns.next()
+                    except (StopIteration, ValueError):
+                        colpos = 1e+20
+                        break
+                    colpos = pileupcolumn.pos
+                    if colpos in positions and not self.skiplocus(snvchr, colpos + 1):
+                        result = self.columncounts(i, pileupcolumn, verdicts)
+                if colpos == snvpos1 and result != None:
+                    yield self.checkminreads(snvchr, snvpos, result)
+                elif self.skiplocus(snvchr, snvpos):
+                    yield self.emptycounts(i)
+                else:
+                    yield self.checkminreads(snvchr, snvpos, self.emptycounts(i))
+
+    def fetchpileups(self,i,samfile,chrommap,loci,verdicts=None):
+        # As windowpileups, but the reads of each window are fetched once
+        # and each is attributed to every locus it covers, as a
+        # FetchedRead, rather than piled up at each locus. Reads are
+        # skipped, and base qualities cut, as in the pileup (see
+        # MINBASEQUALITY), but the pileup max_depth does not apply.
+        column = self.readcolumn(i)
+        for window in self.windows(loci):
+            positions = sorted(set(snvpos - 1 for snvchr, snvpos, ref, alt, snvextra in window))
+            columns = dict()
+            overlaps = MateOverlaps()
+            snvlabel = None
+            try:
+                snvlabel = chrommap(window[0][0])
+                if snvlabel != None:
+                    for al in samfile.fetch(snvlabel, positions[0], positions[-1] + 1):
+                        flag = al.flag
+                        if flag & BAM_DEF_MASK:
+                            continue
+                        if PILEUP_FILTERS:
+                            if (flag & BAM_FPAIRED) and not (flag & BAM_FPROPER_PAIR):
+                                continue
+                            overlaps.push(al)
+                        if column(al) == None:
+                            continue
+                        for pos, qpos, deleted, indel in readpositions(al, positions):
+                            if pos not in columns:
+                                columns[pos] = []
+                            columns[pos].append(FetchedRead(al, qpos, indel, deleted))
+            except ValueError, e:
+                pass # raise e
+            # Counted as the loci are reached, to skip those flagged for
+            # minreads meanwhile
+            results = dict()
+            for snvchr, snvpos, ref, alt, snvextra in window:
+                pos = snvpos - 1
+                if pos not in results:
+                    if self.skiplocus(snvchr, snvpos):
+                        results[pos] = self.emptycounts(i)
+                    elif pos in columns:
+                        reads, lowquality = columns[pos], None
+                        if MINBASEQUALITY > 0:
+                            reads, lowquality = self.qualityreads(i, reads, lambda read: overlaps.quality(read, pos))
+                        results[pos] = self.checkminreads(snvchr, snvpos, self.readscounts(i, snvlabel, pos, reads, verdicts, lowquality))
+                    else:
+                        results[pos] = self.checkminreads(snvchr, snvpos, self.emptycounts(i))
+                yield results[pos]
+
+    def bamindex(self,i):
+        if self.indices[i] == None:
+            self.indices[i] = BAMIndex(BAMIndex.filename(self.samfiles[i]))
+        return self.indices[i]
+
+    def offsetorder(self,i,samfile,chrommap,loci):
+        # (start, window) for the windows of the loci, start the index of
+        # the window's first locus, in ascending virtual file offset of
+        # the window's first locus in BAM file i. Windows without indexed
+        # reads come first, ties keep the loci order.
+        index = self.bamindex(i)
+        keyed = []
+        start = 0
+        for window in self.windows(loci):
+            voffset = None
+            snvlabel = chrommap(window[0][0])
+            if snvlabel != None:
+                voffset = index.voffset(samfile.gettid(snvlabel),window[0][1] - 1)
+            if voffset == None:
+                voffset = -1
+            keyed.append((voffset, start, window))
+            start += len(window)
+        keyed.sort(key=lambda t: t[:2])
+        return [ (start, window) for voffset, start, window in keyed ]
+
+    def offsetpileups(self,pileups,i,samfile,chrommap,loci,verdicts=None):
+        # The results of pileups, in loci order, with the windows of BAM
+        # file i visited in file offset order (see offsetorder). Results
+        # are held until those of all earlier loci are in, only a window's
+        # worth when the file and the loci agree on the chromosome order.
+        held = dict()
+        nextstart = 0
+        for start, window in self.offsetorder(i,samfile,chrommap,loci):
+            held[start] = list(pileups(i,samfile,chrommap,window,verdicts))
+            while nextstart in held:
+                results = held.pop(nextstart)
+                for result in results:
+                    yield result
+                nextstart += len(results)
+
+    def filepileups(self,i,samfile,chrommap,loci):
+        verdicts = None
+        if self.verdicts > 0:
+            verdicts = VerdictCache(self.verdicts)
+        pileups = self.locuspileups
+        if self.fetch:
+            pileups = self.fetchpileups
+        elif self.window > 0:
+            pileups = self.windowpileups
+        if self.fileorder and self.samfiles[i].lower().endswith('.bam'):
+            return self.offsetpileups(pileups,i,samfile,chrommap,loci,verdicts)
+        return pileups(i,samfile,chrommap,loci,verdicts)
+
+    def countsiterator(self):
+        # As iterator, but with the good reads reduced to counts by base,
+        # strand and alignment file, and the removed duplicates.
+        for snvchr, snvpos, ref, alt, total, reads, cnts in self.iterator():
+            counts, duplicates = readcounts(reads,self.unique)
+            yield (snvchr, snvpos, ref, alt, total, counts, cnts, duplicates)
 
 class SerialPileups(Pileups):
 
     def iterator(self):
-        samfiles = []
-        chrommap = []
-        for al in self.samfiles:
-            samfile = pysam.Samfile(al, "rb")
-	    assert samfile._hasIndex(), "Cannot open BAM index for file %s"%sf
-            samfiles.append(samfile)
-            chrommap.append(self.chrreg.chrommap(al))
-            
+        perfile = []
+        for i,al in enumerate(self.samfiles):
+            samfile = openalignments(al, threads=self.threads, reference=self.reference)
+            chrommap = self.chrreg.chrommap(al)
+            perfile.append(self.filepileups(i,samfile,chrommap,self.loci))
+
+        order = self.minreadsorder()
+
         for snvchr, snvpos, ref, alt, snvextra in self.loci:
             cnts = Counter()
             total = Counter()
             reads = []
-            snvpos1 = snvpos - 1
-            for i, samfile in enumerate(samfiles):
-		try:
-		    snvlabel = chrommap[i](snvchr)
-		    if snvlabel != None:
-                      for pileupcolumn in samfile.pileup(snvlabel, snvpos1, snvpos1 + 1, truncate=True):
-                        total[i] += pileupcolumn.n
-                        for pileupread in pileupcolumn.pileups:
-                            try:
-                                al, pos, base, nseg = self.filter.test(pileupread)
-                            except BadRead, e:
-                                cnts[(i, e.message)] += 1
-                                continue
-                            reads.append((al, pos, base, i))
-                            cnts[(i, 'Good')] += 1
-		except ValueError:
-		    pass
-	    total[i] -= cnts[(i,"GapInQueryAtSNVLocus")]
-	    # del cnts[(i,"GapInQueryAtSNVLocus")]
+            results = [None]*len(perfile)
+            for i in order:
+                results[i] = perfile[i].next()
+            for i,(totali, readsi, reasonsi) in enumerate(results):
+                reads.extend(readsi)
+                addreasons(cnts,reasonsi)
+                total.update(totali)
             yield (snvchr, snvpos, ref, alt, total, reads, cnts)
 
-class ThreadedPileups(Pileups):
+class WindowedPileups(SerialPileups):
+    # Dense SNV sets (exomes, germline VCFs) often place many loci within
+    # a read length of each other, these share one index seek and one
+    # pileup iterator per alignment file.
+    def __init__(self,*args,**kw):
+        kw['window'] = kw.get('window',150)
+        super(WindowedPileups,self).__init__(*args,**kw)
+
+class PrefetchPileups(SerialPileups):
+    # SerialPileups with the alignment files read, piled up and filtered
+    # in a background thread, at most prefetch loci ahead of the
+    # consumer, which counts the reads. Loci are handed over in batches.
+    # With readahead, a second thread reads that many bytes of each
+    # alignment file from the indexed offset of each upcoming locus, at
+    # most prefetch loci ahead of the pileups, so the pileups find them
+    # in the OS file cache. Python file reads release the GIL.
     def __init__(self,*args,**kw):
-        super(ThreadedPileups,self).__init__(*args)
+        super(PrefetchPileups,self).__init__(*args,**kw)
+        self.prefetch = kw.get('prefetch',100)
+        self.batch = kw.get('batch',10)
+        self.readahead = kw.get('readahead',0)
+
+    def reader(self,ahead,failed):
+        # Runs readfiles, an exception is passed to the producer in
+        # failed, as sys.exc_info().
+        try:
+            self.readfiles(ahead)
+        except:
+            failed.append(sys.exc_info())
+
+    def readfiles(self,ahead):
+        # Each file is read ahead in the order its loci are piled up
+        files = []
+        for i,al in enumerate(self.samfiles):
+            # Only BAM files have a .bai linear index to read ahead with
+            if not al.lower().endswith('.bam'):
+                continue
+            samfile = openalignments(al)
+            chrommap = self.chrreg.chrommap(al)
+            loci = self.loci
+            if self.fileorder:
+                loci = [ locus for start, window in self.offsetorder(i,samfile,chrommap,self.loci) for locus in window ]
+            files.append([open(al,'rb'), self.bamindex(i), samfile, chrommap, loci, -1])
+        for l in range(len(self.loci)):
+            ahead.acquire()
+            for f in files:
+                bamfile, index, samfile, chrommap, loci, readto = f
+                snvchr, snvpos, ref, alt, snvextra = loci[l]
+                snvlabel = chrommap(snvchr)
+                if snvlabel == None:
+                    continue
+                voffset = index.voffset(samfile.gettid(snvlabel),snvpos-1)
+                if voffset == None or (voffset >> 16) < readto:
+                    continue
+                bamfile.seek(voffset >> 16)
+                bamfile.read(self.readahead)
+                f[-1] = (voffset >> 16) + self.readahead
+        for f in files:
+            f[0].close()
+
+    def producer(self,queue):
+        # Exceptions, also those of the reader, are passed to the consumer
+        # on the queue, as sys.exc_info().
+        try:
+            ahead = None
+            failed = []
+            if self.readahead > 0:
+                ahead = threading.Semaphore(self.prefetch)
+                reader = threading.Thread(target=self.reader,args=(ahead,failed))
+                reader.daemon = True
+                reader.start()
+            batch = []
+            for result in super(PrefetchPileups,self).iterator():
+                if ahead != None:
+                    ahead.release()
+                batch.append(result)
+                if len(batch) == self.batch:
+                    if failed:
+                        raise failed[0][0], failed[0][1], failed[0][2]
+                    queue.put(batch)
+                    batch = []
+            if ahead != None:
+                reader.join()
+                if failed:
+                    raise failed[0][0], failed[0][1], failed[0][2]
+            queue.put(batch)
+        except:
+            queue.put(sys.exc_info())
+            return
+        queue.put(None)
+
+    def iterator(self):
+        queue = Queue.Queue(max(1,self.prefetch//self.batch))
+        t = threading.Thread(target=self.producer,args=(queue,))
+        t.daemon = True
+        t.start()
+        while True:
+            batch = queue.get()
+            if batch == None:
+                break
+            if isinstance(batch,tuple):
+                raise batch[0], batch[1], batch[2]
+            for result in batch:
+                yield result
+
+class FetchPileups(SerialPileups):
+    # Dense SNV sets (germline VCFs) place many loci within each read, a
+    # read is decoded and filtered once for all of them.
+    def __init__(self,*args,**kw):
+        kw['fetch'] = True
+        super(FetchPileups,self).__init__(*args,**kw)
+
+class ScheduledPileups(Pileups):
+    # Workers for each alignment file pull contiguous chunks of loci from
+    # a shared work queue, so a slow (deep) locus only delays the worker
+    # that has it. Chunks shrink towards the end of the loci to spread
+    # the tail over all workers. Results are buffered until they can be
+    # yielded in loci order; the number of chunks taken but not yet
+    # consumed is bounded by maxchunks per alignment file.
+    def __init__(self,*args,**kw):
+        super(ScheduledPileups,self).__init__(*args,**kw)
+        self.minchunk = kw.get('minchunk',5)
+        self.maxchunk = kw.get('maxchunk',200)
+
+    def chunks(self,workers):
+        start = 0
+        n = len(self.loci)
+        while start < n:
+            size = (n - start)//(2*workers)
+            size = min(self.maxchunk,max(self.minchunk,size))
+            yield start, min(n,start+size)
+            start += size
+
+    def schedule(self,workers,queue,semaphore):
+        self._work = []
+        self._credits = []
+        self._chunkends = set()
+        chunks = list(self.chunks(workers))
+        for i in range(self.nb):
+            self._work.append(queue())
+            self._credits.append(semaphore(self.maxchunks))
+            for chunk in chunks:
+                self._work[i].put(chunk)
+                self._chunkends.add(chunk[1])
+            for j in range(workers):
+                self._work[i].put(None)
+
+    def nextchunk(self,i):
+        self._credits[i].acquire()
+        return self._work[i].get()
+
+    def chunkdone(self,l):
+        # Called by the consumer after each locus
+        if (l+1) in self._chunkends:
+            for i in range(self.nb):
+                self._credits[i].release()
+
+class ThreadedPileups(ScheduledPileups):
+    def __init__(self,*args,**kw):
+        super(ThreadedPileups,self).__init__(*args,**kw)
         self.tpb = kw.get('threadsperbam',1)
         self.nb = len(self.samfiles)
         self.nt = self.tpb*self.nb
+        self.maxchunks = kw.get('maxchunks',4*self.tpb)
+        self.schedule(self.tpb,Queue.Queue,threading.Semaphore)
         self._queue = []
-        k = 0;
+        for i in range(self.nb):
+            self._queue.append(Queue.Queue())
         for j in range(self.tpb):
             for i in range(self.nb):
-                self._queue.append(Queue.Queue(20))
-                t = threading.Thread(target=self.worker,args=(i,j,k))
-		t.daemon = True
+                t = threading.Thread(target=self.worker,args=(i,j))
+                t.daemon = True
                 t.start()
-                k += 1
-	    time.sleep(1)
 
-    def worker(self,i,j,k):
-        samfile = pysam.Samfile(self.samfiles[i], "rb")
-	assert samfile._hasIndex(), "Cannot open BAM index for file %s"%sf
-	chrommap = self.chrreg.chrommap(self.samfiles[i])
-	# blocksize = int(math.ceil(len(self.loci)/self.tpb))
-	# for l in range(j*blocksize,min((j+1)*blocksize,len(self.loci))):
-	for l in range(j,len(self.loci),self.tpb):
-	    snvchr, snvpos, ref, alt, snvextra = self.loci[l]
-            cnts = Counter()
-            total = Counter()
-            reads = []
-            snvpos1 = snvpos - 1
-	    try:
-		snvlabel = chrommap(snvchr)
-		if snvlabel != None:
-                  for pileupcolumn in samfile.pileup(snvlabel, snvpos1, snvpos1 + 1, truncate=True):
-                    total[i] += pileupcolumn.n
-                    for pileupread in pileupcolumn.pileups:
-                        try:
-                            al, pos, base, nseg = self.filter.test(pileupread)
-                        except BadRead, e:
-                            cnts[(i, e.message)] += 1
-                            continue
-                        reads.append((al, pos, base, i))
-                        cnts[(i, 'Good')] += 1
-	    except ValueError, e:
-	        pass # raise e
-	    total[i] -= cnts[(i,"GapInQueryAtSNVLocus")]
-	    # del cnts[(i,"GapInQueryAtSNVLocus")]
-	    # print >>sys.stderr, (snvchr, snvpos, ref, alt, total, cnts)
-            self._queue[k].put((snvchr, snvpos, ref, alt, total, reads, cnts))
+    def worker(self,i,j):
+        samfile = openalignments(self.samfiles[i], threads=self.threads, reference=self.reference)
+        chrommap = self.chrreg.chrommap(self.samfiles[i])
+        while True:
+            chunk = self.nextchunk(i)
+            if chunk == None:
+                break
+            start, end = chunk
+            for l,result in enumerate(self.filepileups(i,samfile,chrommap,self.loci[start:end]),start):
+                self._queue[i].put((l, result))
         return
-        
+
     def iterator(self):
-        k = 0
-	# for i in range(len(self.loci)):
-        for snvchr, snvpos, ref, alt, snvextra in self.loci:
+        pending = [ dict() for i in range(self.nb) ]
+        for l,(snvchr, snvpos, ref, alt, snvextra) in enumerate(self.loci):
             cnts = Counter()
             total = Counter()
             reads = []
-            for i in range(len(self.samfiles)):
-                snvchri, snvposi, refi, alti, totali, readsi, cntsi = self._queue[k].get()
-                assert(snvchri == snvchr and snvposi == snvpos)
-                assert(i in totali or len(totali.keys()) == 0)
+            for i in range(self.nb):
+                while l not in pending[i]:
+                    li, result = self._queue[i].get()
+                    pending[i][li] = result
+                totali, readsi, reasonsi = pending[i].pop(l)
+                assert(set(totali.keys()) <= set(self.filecolumns[i]))
                 reads.extend(readsi)
-                cnts.update(cntsi)
+                addreasons(cnts,reasonsi)
                 total.update(totali)
-                self._queue[k].task_done()
-                k = (k+1)%self.nt
+            self.chunkdone(l)
             yield (snvchr, snvpos, ref, alt, total, reads, cnts)
 
-PileupAlignment = namedtuple('PileupAlignment',['seq','is_reverse'])
+class CountsRing(object):
+    # Ring of fixed-layout count row batches in shared memory, written by
+    # one worker process and read in place by the consumer. Only the
+    # hand-off of each slot is signalled, through a pair of semaphores.
+    def __init__(self,slots=20,rows=100):
+        self.slots = slots
+        self.rows = rows
+        self._buffer = multiprocessing.RawArray(ctypes.c_int64, slots*rows*COUNTSWIDTH)
+        self._nrows = multiprocessing.RawArray(ctypes.c_int64, slots)
+        self._free = multiprocessing.Semaphore(slots)
+        self._full = multiprocessing.Semaphore(0)
+        self._view = None
+        self._put = 0
+        self._get = 0
+
+    def view(self):
+        if self._view is None:
+            self._view = numpy.frombuffer(self._buffer,dtype=numpy.int64)
+            self._view = self._view.reshape((self.slots,self.rows,COUNTSWIDTH))
+        return self._view
+
+    def reserve(self):
+        # Producer: wait for a free slot and return its (zeroed) rows.
+        self._free.acquire()
+        rows = self.view()[self._put]
+        rows[:] = 0
+        return rows
 
-class MultiprocPileups(Pileups):
+    def commit(self,n):
+        self._nrows[self._put] = n
+        self._put = (self._put+1)%self.slots
+        self._full.release()
+
+    def get(self):
+        # Consumer: wait for the next filled slot and return its rows,
+        # which remain valid until released. Slots are released in the
+        # order they were got.
+        self._full.acquire()
+        rows = self.view()[self._get][:self._nrows[self._get]]
+        self._get = (self._get+1)%self.slots
+        return rows
+
+    def release(self):
+        self._free.release()
+
+class MultiprocPileups(ScheduledPileups):
     # A python class for alignments since the C++ wrapped data-structure
     # doesn't survive the multiprocess communication process...
+    # Alternatively, with countsonly, workers reduce the reads at each
+    # locus to fixed-layout integer counts (see COUNTSWIDTH) and pass
+    # batches of loci through a shared memory CountsRing, for use with
+    # countsiterator. Only the index of the worker with a filled batch is
+    # sent to the consumer.
     def __init__(self,*args,**kw):
-        super(MultiprocPileups,self).__init__(*args)
-        self.tpb = kw.get('procperbam',1)
+        super(MultiprocPileups,self).__init__(*args,**kw)
+        self.tpb = kw.get('procsperbam',1)
+        self.countsonly = kw.get('countsonly',False)
+        self.batch = kw.get('batch',100)
         self.nb = len(self.samfiles)
         self.nt = self.tpb*self.nb
+        self.maxchunks = kw.get('maxchunks',4*self.tpb)
+        self.schedule(self.tpb,multiprocessing.Queue,multiprocessing.Semaphore)
         self._queue = []
+        self._rings = []
+        for i in range(self.nb):
+            self._queue.append(multiprocessing.Queue())
         k = 0;
         for j in range(self.tpb):
             for i in range(self.nb):
-                self._queue.append(multiprocessing.Queue(20))
+                if self.countsonly:
+                    self._rings.append(CountsRing(20,self.batch*len(self.filecolumns[i])))
                 t = multiprocessing.Process(target=self.worker,args=(i,j,k))
-		t.daemon = True
+                t.daemon = True
                 t.start()
                 k += 1
-	    time.sleep(1)
+
+    def alignment(self,al):
+        if self.countsonly:
+            return al
+        return PileupAlignment(al.query_sequence,al.is_reverse)
+
+    def flags(self,n):
+        # Shared with the worker processes
+        return multiprocessing.RawArray(ctypes.c_byte,n)
 
     def worker(self,i,j,k):
-        samfile = pysam.Samfile(self.samfiles[i], "rb")
-	assert samfile._hasIndex(), "Cannot open BAM index for file %s"%sf
-	chrommap = self.chrreg.chrommap(self.samfiles[i])
-	# blocksize = int(math.ceil(len(self.loci)/self.tpb))
-	# for l in range(j*blocksize,min((j+1)*blocksize,len(self.loci))):
-	for l in range(j,len(self.loci),self.tpb):
-	    snvchr, snvpos, ref, alt, snvextra = self.loci[l]
-            cnts = Counter()
-            total = Counter()
-            reads = []
-            snvpos1 = snvpos - 1
-	    try:
-		snvlabel = chrommap(snvchr)
-		if snvlabel != None:
-                  for pileupcolumn in samfile.pileup(snvlabel, snvpos1, snvpos1 + 1, truncate=True):
-                    total[i] += pileupcolumn.n
-                    for pileupread in pileupcolumn.pileups:
-                        try:
-                            al, pos, base, nseg = self.filter.test(pileupread)
-                        except BadRead, e:
-                            cnts[(i, e.message)] += 1
-                            continue
-                        reads.append((PileupAlignment(al.seq,al.is_reverse), pos, base, i))
-                        cnts[(i, 'Good')] += 1
-	    except ValueError, e:
-	        pass # raise e
-	    total[i] -= cnts[(i,"GapInQueryAtSNVLocus")]
-	    # del cnts[(i,"GapInQueryAtSNVLocus")]
-	    # print >>sys.stderr, (snvchr, snvpos, ref, alt, total, cnts)
-            self._queue[k].put((snvchr, snvpos, ref, alt, total, reads, cnts))
+        samfile = openalignments(self.samfiles[i], threads=self.threads, reference=self.reference)
+        chrommap = self.chrreg.chrommap(self.samfiles[i])
+        while True:
+            chunk = self.nextchunk(i)
+            if chunk == None:
+                break
+            start, end = chunk
+            results = self.filepileups(i,samfile,chrommap,self.loci[start:end])
+            if self.countsonly:
+                self.countsworker(i,k,start,results)
+                continue
+            for l,result in enumerate(results,start):
+                self._queue[i].put((l, result))
         return
-        
+
+    def countsworker(self,i,k,start,results):
+        # Each locus has a row for each column of alignment file i. Each
+        # chunk's last batch is handed over even if it is not full, the
+        # consumer may be waiting for it.
+        ring = self._rings[k]
+        rows = None
+        for l,(total, reads, reasons) in enumerate(results,start):
+            counts, duplicates = readcounts(reads,self.unique)
+            if rows is None:
+                rows = ring.reserve()
+                n = 0
+            for j in self.filecolumns[i]:
+                packcounts(rows[n],l,j,total,counts,reasons[j],duplicates)
+                n += 1
+            if n == ring.rows:
+                ring.commit(n)
+                self._queue[i].put(k)
+                rows = None
+        if rows is not None:
+            ring.commit(n)
+            self._queue[i].put(k)
+        return
+
     def iterator(self):
-        k = 0
-	# for i in range(len(self.loci)):
-        for snvchr, snvpos, ref, alt, snvextra in self.loci:
+        assert not self.countsonly, "Use countsiterator with countsonly workers"
+        pending = [ dict() for i in range(self.nb) ]
+        for l,(snvchr, snvpos, ref, alt, snvextra) in enumerate(self.loci):
             cnts = Counter()
             total = Counter()
             reads = []
-            for i in range(len(self.samfiles)):
-                snvchri, snvposi, refi, alti, totali, readsi, cntsi = self._queue[k].get()
-                assert(snvchri == snvchr and snvposi == snvpos)
-                assert(i in totali or len(totali.keys()) == 0)
+            for i in range(self.nb):
+                while l not in pending[i]:
+                    li, result = self._queue[i].get()
+                    pending[i][li] = result
+                totali, readsi, reasonsi = pending[i].pop(l)
+                assert(set(totali.keys()) <= set(self.filecolumns[i]))
                 reads.extend(readsi)
-                cnts.update(cntsi)
+                addreasons(cnts,reasonsi)
                 total.update(totali)
-                # self._queue[k].task_done()
-                k = (k+1)%self.nt
+            self.chunkdone(l)
             yield (snvchr, snvpos, ref, alt, total, reads, cnts)
 
+    def countsiterator(self):
+        if not self.countsonly:
+            for result in super(MultiprocPileups,self).countsiterator():
+                yield result
+            return
+        # Batches stay in their ring slot until all of their rows have
+        # been used, each worker's batches are used up in ring order.
+        pending = [ dict() for i in range(self.nb) ]
+        for l,(snvchr, snvpos, ref, alt, snvextra) in enumerate(self.loci):
+            cnts = Counter()
+            total = Counter()
+            counts = Counter()
+            duplicates = Counter()
+            for i in range(self.nb):
+                while l not in pending[i]:
+                    k = self._queue[i].get()
+                    rows = self._rings[k].get()
+                    batch = [k, len(rows)]
+                    for row in rows:
+                        pending[i].setdefault(int(row[COUNTSLOCUS]),[]).append((row, batch))
+                for row, batch in pending[i].pop(l):
+                    unpackcounts(row,total,counts,cnts,duplicates)
+                    batch[1] -= 1
+                    if batch[1] == 0:
+                        self._rings[batch[0]].release()
+            self.chunkdone(l)
+            yield (snvchr, snvpos, ref, alt, total, counts, cnts, duplicates)
+
+_shardpileups = None
+_shardfiles = None
+
+def _shardinit(pileups):
+    global _shardpileups, _shardfiles
+    _shardpileups = pileups
+    _shardfiles = None
+
+def _shardworker(shard):
+    # Counts for a contiguous shard of the loci, from every alignment file,
+    # as a (loci, columns, COUNTSWIDTH) array.
+    global _shardfiles
+    self = _shardpileups
+    if _shardfiles == None:
+        _shardfiles = []
+        for al in self.samfiles:
+            samfile = openalignments(al, threads=self.threads, reference=self.reference)
+            _shardfiles.append((samfile, self.chrreg.chrommap(al)))
+    start, end = shard
+    rows = numpy.zeros((end-start,len(self.columns),COUNTSWIDTH),dtype=numpy.int64)
+    for i in self.minreadsorder():
+        samfile, chrommap = _shardfiles[i]
+        results = self.filepileups(i,samfile,chrommap,self.loci[start:end])
+        for l,(total, reads, reasons) in enumerate(results):
+            counts, duplicates = readcounts(reads,self.unique)
+            for j in self.filecolumns[i]:
+                packcounts(rows[l,j],start+l,j,total,counts,reasons[j],duplicates)
+    return rows
+
+class ShardedPileups(Pileups):
+    # Each worker process counts reads for a contiguous shard of the loci
+    # in every alignment file, so each pass over a BAM reads a contiguous
+    # region. Loci are in chromosome order (ChromLabelRegistry.chrom_order)
+    # and shards either follow chromosomes or split each chromosome into
+    # ranges with similar numbers of loci. Shards are merged back in loci
+    # order, at most two shards per process are held in memory.
+    def __init__(self,*args,**kw):
+        super(ShardedPileups,self).__init__(*args,**kw)
+        self.processes = kw.get('processes',multiprocessing.cpu_count())
+        self.shardby = kw.get('shardby','range')
+        self.nshards = kw.get('shards',4*self.processes)
+
+    def shards(self):
+        chroms = []
+        start = 0
+        for l in range(1,len(self.loci)+1):
+            if l == len(self.loci) or self.loci[l][0] != self.loci[start][0]:
+                chroms.append((start,l))
+                start = l
+        if self.shardby == 'chromosome':
+            return chroms
+        size = max(1,int(math.ceil(len(self.loci)/float(self.nshards))))
+        shards = []
+        for start,end in chroms:
+            for l in range(start,end,size):
+                shards.append((l,min(end,l+size)))
+        return shards
+
+    def iterator(self):
+        raise RuntimeError("Use countsiterator with sharded pileups")
+
+    def countsiterator(self):
+        pool = multiprocessing.Pool(self.processes,_shardinit,(self,))
+        shards = iter(self.shards())
+        pending = []
+        for shard in shards:
+            pending.append(pool.apply_async(_shardworker,(shard,)))
+            if len(pending) >= 2*self.processes:
+                break
+        l = 0
+        while len(pending) > 0:
+            rows = pending.pop(0).get()
+            for shard in shards:
+                pending.append(pool.apply_async(_shardworker,(shard,)))
+                break
+            for locusrows in rows:
+                snvchr, snvpos, ref, alt, snvextra = self.loci[l]
+                cnts = Counter()
+                total = Counter()
+                counts = Counter()
+                duplicates = Counter()
+                for row in locusrows:
+                    assert(row[COUNTSLOCUS] == l)
+                    unpackcounts(row,total,counts,cnts,duplicates)
+                l += 1
+                yield (snvchr, snvpos, ref, alt, total, counts, cnts, duplicates)
+        pool.close()
+        pool.join()
@@ -2,5 +2,90 @@ import pkg_resources
 # can't find it in the frozen library.zip...
 # pkg_resources.require("pysam>=0.8.1")
 import pysam
+import multiprocessing
+import os
 NEEDED_VERSION = "0.8.1"
 assert pkg_resources.parse_version(pysam.version.__version__) >= pkg_resources.parse_version(NEEDED_VERSION), "PySam version at least %s required"%(NEEDED_VERSION,)
+
+# pysam's pileup always skips unmapped, secondary, QC fail and duplicate
+# reads. pysam 0.15 also piles up reads as samtools mpileup does: orphan
+# mates are skipped, the base qualities of overlapping mates are adjusted
+# and bases of quality below 13 are left out of a column's reads, though
+# not its depth (PileupColumn.n).
+PILEUP_FILTERS = pkg_resources.parse_version(pysam.version.__version__) >= pkg_resources.parse_version("0.15.0")
+
+# pysam 0.10 opens CRAM files with an explicit reference sequence FASTA
+CRAM_VERSION = "0.10.0"
+CRAM_FILES = pkg_resources.parse_version(pysam.version.__version__) >= pkg_resources.parse_version(CRAM_VERSION)
+
+# pysam 0.10 gives the bases of the reads in a pileup column, with
+# strand, indels and gaps, as strings from C (see
+# PileupColumn.get_query_sequences).
+BASECOUNTS = hasattr(getattr(pysam, 'PileupColumn', None), 'get_query_sequences')
+
+# Reference sequence FASTA for CRAM files not given one explicitly, see
+# setreference
+_reference = None
+
+# Whether pysam's AlignmentFile takes htslib BGZF threads, found out on
+# first use
+_bgzfthreads = None
+
+def hasindex(samfile):
+    if hasattr(samfile, 'has_index'):
+        return samfile.has_index()
+    return samfile._hasIndex()
+
+def setreference(reference=None, cache=None):
+    # Reference sequence FASTA used to decode CRAM files, and the local
+    # directory in which htslib caches the reference sequences it looks
+    # up by MD5 checksum (REF_CACHE). Set before any CRAM file is opened;
+    # worker processes inherit the cache from the environment.
+    global _reference
+    _reference = reference
+    if cache:
+        os.environ['REF_CACHE'] = os.path.join(os.path.abspath(cache), '%2s', '%2s', '%s')
+
+def alignmentsmode(filename):
+    # pysam file mode from the alignment file's extension
+    if filename.lower().endswith('.cram'):
+        return "rc"
+    if filename.lower().endswith('.sam'):
+        return "r"
+    return "rb"
+
+def openalignments(filename, mode=None, threads=0, index=True, reference=None):
+    # Open an alignment file with threads htslib decompression threads,
+    # if pysam supports them, and check for its index. CRAM files are
+    # decoded using reference, or the FASTA set by setreference.
+    global _bgzfthreads
+    if mode == None:
+        mode = alignmentsmode(filename)
+    kw = {}
+    if 'c' in mode:
+        if not CRAM_FILES:
+            raise RuntimeError("PySam version at least %s required for CRAM file %s"%(CRAM_VERSION, filename))
+        if reference == None:
+            reference = _reference
+        if reference:
+            kw['reference_filename'] = reference
+    samfile = None
+    if threads > 0 and _bgzfthreads != False:
+        try:
+            samfile = pysam.Samfile(filename, mode, threads=threads, **kw)
+            _bgzfthreads = True
+        except TypeError:
+            _bgzfthreads = False
+    if samfile == None:
+        samfile = pysam.Samfile(filename, mode, **kw)
+    if index:
+        assert hasindex(samfile), "Cannot open BAM/CRAM index for file %s"%filename
+    return samfile
+
+def decompressionthreads(threads, openfiles):
+    # Decompression threads per open alignment file, 0 for none (the
+    # command-line default), negative threads shares the CPUs between
+    # the open files and their own threads.
+    if threads >= 0:
+        return threads
+    return max(0, multiprocessing.cpu_count()//max(1, openfiles) - 1)
@@ -7,9 +7,8 @@ try:
 except NameError:
     pass
 
-from pysamimport import pysam
+from pysamimport import openalignments
 
 for filename in sys.argv[1:]:
-    samfile = pysam.Samfile(filename, "rb")
-    assert samfile._hasIndex(), "Cannot open BAM index for file %s"%filename
+    samfile = openalignments(filename)
     print filename,"\n  "+", ".join(samfile.references)+"."
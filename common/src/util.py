@@ -3,6 +3,7 @@ import sys
 from pysamimport import pysam
 import re
 import inspect
+import bisect
 
 
 class BadRead(RuntimeError):
@@ -74,14 +75,111 @@ class TooManyQueryGaps(BadRead):
 class MappingQualityTooLow(BadRead):
     header = "MappingQualityTooLow"
 
-BadRead.allheaders = map(lambda cls: cls[1].header, inspect.getmembers(sys.modules[
-                         __name__], lambda member: inspect.isclass(member) and issubclass(member, BadRead) and member != BadRead))
+# Integer read classification codes: GOOD (0) for reads that pass the
+# filter, and each BadRead subclass numbered in header order. The reason
+# columns (BadRead.allheaders, READREASONS) and the per-alignment file
+# reason count arrays (see reasoncounts) share this order.
+GOOD = 0
+_badreads = sorted(map(lambda cls: cls[1], inspect.getmembers(sys.modules[
+                   __name__], lambda member: inspect.isclass(member) and issubclass(member, BadRead) and member != BadRead)),
+                   key=lambda cls: cls.header)
+for code, cls in enumerate(_badreads, 1):
+    cls.code = code
+del code, cls
+BadRead.allheaders = map(lambda cls: cls.header, _badreads)
+BadRead.bycode = [None] + _badreads
+READREASONS = ['Good'] + BadRead.allheaders
+
+
+def reasoncounts():
+    # Read counts indexed by classification code
+    return [0] * len(READREASONS)
 
 BAM_CMATCH = 0
+BAM_CINS = 1
+BAM_CDEL = 2
 BAM_CREF_SKIP = 3
-
-
-class ReadFilter(object):
+BAM_CSOFT_CLIP = 4
+BAM_CEQUAL = 7
+BAM_CDIFF = 8
+
+BAM_FPAIRED = 1
+BAM_FPROPER_PAIR = 2
+BAM_FUNMAP = 4
+BAM_FMUNMAP = 8
+BAM_FSECONDARY = 256
+BAM_FQCFAIL = 512
+BAM_FDUP = 1024
+BAM_DEF_MASK = (BAM_FUNMAP | BAM_FSECONDARY | BAM_FQCFAIL | BAM_FDUP)
+
+
+class ReadClassifier(object):
+
+    # Filters implement classify, which returns the classification code
+    # and, for GOOD reads, the value returned by test. test raises the
+    # BadRead subclass for rejected reads instead.
+    def test(self, read):
+        code, result = self.classify(read)
+        if code != GOOD:
+            raise BadRead.bycode[code]()
+        return result
+
+    # Filters that, beyond the flagged reads (BAM_DEF_MASK) the pileup
+    # skips, reject only reads with an indel at or a gap over the
+    # position, if any, classify reads from their base in the pileup
+    # column alone (see basecode).
+    basecounts = False
+    rejectindels = True
+
+    def basecode(self, qseq):
+        # Classification code and, for GOOD reads, (base, reverse) of a
+        # read from its PileupColumn.get_query_sequences string, with
+        # add_indels: the base, in lower case on the reverse strand, '*'
+        # in a deletion or '<'/'>' in a reference skip, then any indel.
+        if self.rejectindels and ('+' in qseq or '-' in qseq):
+            return IndelAtSNV.code, None
+        base = qseq[0]
+        if base in '*<>':
+            return GapAtSNV.code, None
+        return GOOD, (base.upper(), base.islower())
+
+
+def readpositions(al, positions):
+    # (position, query position, deleted, indel) for each of the (sorted,
+    # 0-based) positions covered by the read, as in a pileup: positions
+    # in a deletion or reference skip are deleted, the last aligned base
+    # before an insertion or deletion has its (signed) length as indel.
+    # Unmapped reads are never in a pileup.
+    if al.is_unmapped:
+        return
+    cigar = al.cigar
+    start = al.pos
+    qpos = 0
+    for k, (op, length) in enumerate(cigar):
+        if op in (BAM_CMATCH, BAM_CEQUAL, BAM_CDIFF):
+            end = start + length
+            for pos in positions[bisect.bisect_left(positions, start):
+                                 bisect.bisect_left(positions, end)]:
+                indel = 0
+                if pos == end - 1 and k + 1 < len(cigar):
+                    if cigar[k + 1][0] == BAM_CINS:
+                        indel = cigar[k + 1][1]
+                    elif cigar[k + 1][0] == BAM_CDEL:
+                        indel = -cigar[k + 1][1]
+                yield pos, qpos + (pos - start), False, indel
+            start = end
+            qpos += length
+        elif op in (BAM_CDEL, BAM_CREF_SKIP):
+            end = start + length
+            for pos in positions[bisect.bisect_left(positions, start):
+                                 bisect.bisect_left(positions, end)]:
+                yield pos, qpos, True, 0
+            start = end
+        elif op in (BAM_CINS, BAM_CSOFT_CLIP):
+            qpos += length
+
+
+class ReadFilter(ReadClassifier):
     NONH = "Warning: Tag NH missing from alignments"
     NONM = "Warning: Tag NM missing from alignments"
     NOMD = "Warning: Tag MD missing from alignments"
@@ -98,41 +196,69 @@ class ReadFilter(object):
         if self.warnings == None:
             self.warnings = set()
 
-    def test(self, al):
+    def classify(self, al):
         if al.is_duplicate:
-            raise IsDuplicate()
+            return IsDuplicate.code, None
         if al.is_qcfail:
-            raise IsQCFail()
+            return IsQCFail.code, None
         if al.is_secondary:
-            raise IsSecondary()
+            return IsSecondary.code, None
         if al.is_unmapped:
-            raise IsUnmapped()
+            return IsUnmapped.code, None
         if al.qlen < self.minlength:
-            raise TooShort()
+            return TooShort.code, None
         if al.mapq < self.mapq:
-            raise MappingQualityTooLow()
+            return MappingQualityTooLow.code, None
         try:
             if int(al.opt('NH')) > self.maxhits:
-                raise TooManyHits()
+                return TooManyHits.code, None
         except KeyError:
             if self.NONH in self.warnings:
                 print >>sys.stderr, self.NONH + \
                     ".\n         Cannot filter out reads that align to mutiple loci."
                 self.warnings.remove(self.NONH)
         if any(map(lambda t: t[0] not in (BAM_CMATCH, BAM_CREF_SKIP), al.cigar)):
-            raise BadCigar()
+            return BadCigar.code, None
         segments = [t[1] for t in al.cigar if t[0] == BAM_CMATCH]
         if len(segments) > self.maxsegments:
-            raise TooManyQueryGaps()
+            return TooManyQueryGaps.code, None
         try:
             if int(al.opt('NM')) > self.maxedits:
-                raise TooManyEdits()
+                return TooManyEdits.code, None
         except KeyError:
             if self.NONM in self.warnings:
                 print >>sys.stderr, self.NONM + \
                     ".\n         Cannot filter out reads with too many substitutions."
                 self.warnings.remove(self.NONM)
-        return segments
+        return GOOD, segments
+
+
+# MD tag runs of matching bases, each followed by a substituted reference
+# base or a ^-prefixed deletion (none after the last run).
+MDEDITS = re.compile(r'(\d+)(\^[A-Z]+|[A-Z])?')
+
+
+class EditMap(object):
+
+    # Edits of one read, in query coordinates, computed once per read:
+    # aligned segment lengths and end positions, substitution positions
+    # from the MD tag (None without MD) and the NM edit distance (None
+    # without NM). Bases are read from the query sequence pysam decodes,
+    # and caches, on al, the read's alignment at the first locus, so the
+    # sequence is decoded once however many loci the read covers.
+    def __init__(self, al, segments, substs, nm):
+        self.al = al
+        self.segments = segments
+        self.ends = []
+        end = 0
+        for length in segments:
+            end += length
+            self.ends.append(end)
+        self.substs = substs
+        self.nm = nm
+
+    def base(self, pos):
+        return self.al.query_sequence[pos]
 
 
 class SNVPileupReadFilter(ReadFilter):
@@ -144,94 +270,121 @@ class SNVPileupReadFilter(ReadFilter):
         self.minsubstdist = minsubstdist
 	super(SNVPileupReadFilter,self).__init__(**kw)
 
-    def findseg(self, pos, segments):
-        i = 0
-        while True:
-            if (pos <= segments[i]):
-                return i, pos
-            pos -= segments[i]
-            i += 1
-        return None
+    def findseg(self, pos, editmap):
+        # Segment containing query position pos, and pos relative to the
+        # segment start.
+        i = bisect.bisect_left(editmap.ends, pos)
+        return i, pos - (editmap.ends[i] - editmap.segments[i])
 
-    def test(self, pileupread):
+    def editmap(self, al, segments):
+        # Reads that pass classify align without soft clips, insertions
+        # or deletions, so the query position of a substitution is the
+        # number of matching and substituted bases before it.
+        try:
+            substs = []
+            pos = 0
+            for run, edit in MDEDITS.findall(al.opt('MD')):
+                pos += int(run)
+                if edit and edit[0] != '^':
+                    substs.append(pos)
+                    pos += 1
+        except KeyError:
+            substs = None
+        try:
+            nm = int(al.opt('NM'))
+        except KeyError:
+            nm = None
+        return EditMap(al, segments, substs, nm)
+
+    def classifyalignment(self, al):
+        code, segments = super(SNVPileupReadFilter,self).classify(al)
+        if code != GOOD:
+            return code, None
+        return GOOD, self.editmap(al, segments)
+
+    def classify(self, pileupread, verdicts=None):
+        # Only the checks below that depend on the locus are repeated for
+        # reads found in verdicts (see pileups.VerdictCache).
         if pileupread.indel != 0:
-            raise IndelAtSNV()
+            return IndelAtSNV.code, None
         if pileupread.is_del:
-            raise GapAtSNV()
+            return GapAtSNV.code, None
         al = pileupread.alignment
-        segments = super(SNVPileupReadFilter,self).test(al)
+        if verdicts != None:
+            code, editmap = verdicts.verdict(al, self.classifyalignment)
+        else:
+            code, editmap = self.classifyalignment(al)
+        if code != GOOD:
+            return code, None
         qpos = pileupread.query_position
-        seg, qpos = self.findseg(qpos, segments)
-        if qpos < self.minpad or (segments[seg] - qpos) < self.minpad:
-            raise SNVPadding()
-        try:
-            edits = re.split(r'(\d+)', al.opt('MD'))[1:-1]
-            substs = dict()
-            reference = None
-            for i in range(0, len(edits) - 1, 2):
-                pos = int(edits[i])
-                substs[pos] = (edits[i + 1], al.seq[pileupread.query_position])
-                if pos == pileupread.query_position:
-                    reference = edits[i + 1]
-                elif abs(pos - pileupread.query_position) < self.minsubstdist:
-                    raise SNVEditPadding()
-            try:
-                if int(al.opt('NM')) > (self.maxedits + (0 if (reference) else 1)):
-                    raise TooManyEditsOtherThanSNV()
-            except KeyError:
-                if self.NONM in self.warnings:
-                    print >>sys.stderr, self.NONM + \
-                        ".\n         Cannot filter out reference reads with one too many\n         substitutions."
-                    self.warnings.remove(self.NONM)
-
-        except KeyError:
-            if self.NOMD in self.warnings:
-                print >>sys.stderr, self.NOMD + \
-                    ".\n         Cannot filter out reads with edits too close to the SNV locus\n         or reference reads with one too many substitutions."
-                self.warnings.remove(self.NOMD)
+        seg, segpos = self.findseg(qpos, editmap)
+        if segpos < self.minpad or (editmap.segments[seg] - segpos) < self.minpad:
+            return SNVPadding.code, None
+        if editmap.substs != None:
+            reference = False
+            for pos in editmap.substs:
+                if pos == qpos:
+                    reference = True
+                elif abs(pos - qpos) < self.minsubstdist:
+                    return SNVEditPadding.code, None
+            if editmap.nm != None:
+                if editmap.nm > (self.maxedits + (0 if (reference) else 1)):
+                    return TooManyEditsOtherThanSNV.code, None
+            elif self.NONM in self.warnings:
+                print >>sys.stderr, self.NONM + \
+                    ".\n         Cannot filter out reference reads with one too many\n         substitutions."
+                self.warnings.remove(self.NONM)
+        elif self.NOMD in self.warnings:
+            print >>sys.stderr, self.NOMD + \
+                ".\n         Cannot filter out reads with edits too close to the SNV locus\n         or reference reads with one too many substitutions."
+            self.warnings.remove(self.NOMD)
 
-        readbase = al.seq[pileupread.query_position]
-        return al, pileupread.query_position, readbase, segments
+        # The read's alignment at its first locus, whose query sequence
+        # is already decoded, stands in for al
+        return GOOD, (editmap.al, qpos, editmap.base(qpos), editmap.segments)
 
 
-class NoFilter:
+class NoFilter(ReadClassifier):
+    basecounts = True
+    rejectindels = False
 
     def __init__(self):
         pass
 
-    def test(self, pileupread):
+    def classify(self, pileupread, verdicts=None):
         al = pileupread.alignment
-        readbase = al.seq[pileupread.query_position]
-        return al, pileupread.query_position, readbase, 1
+        readbase = al.query_sequence[pileupread.query_position]
+        return GOOD, (al, pileupread.query_position, readbase, 1)
 
 
-class BasicFilter:
+class BasicFilter(ReadClassifier):
+    basecounts = True
 
     def __init__(self):
         pass
 
-    def test(self, pileupread):
+    def classify(self, pileupread, verdicts=None):
         if pileupread.indel != 0:
-            raise IndelAtSNV()
+            return IndelAtSNV.code, None
         if pileupread.is_del:
-            raise GapAtSNV()
+            return GapAtSNV.code, None
         al = pileupread.alignment
         if al.is_duplicate:
-            raise IsDuplicate()
+            return IsDuplicate.code, None
         if al.is_qcfail:
-            raise IsQCFail()
+            return IsQCFail.code, None
         if al.is_secondary:
-            raise IsSecondary()
+            return IsSecondary.code, None
         if al.is_unmapped:
-            raise IsUnmapped()
-        readbase = al.seq[pileupread.query_position]
-        return al, pileupread.query_position, readbase, 1
+            return IsUnmapped.code, None
+        readbase = al.query_sequence[pileupread.query_position]
+        return GOOD, (al, pileupread.query_position, readbase, 1)
 
 
-class AllFilter:
+class AllFilter(ReadClassifier):
 
     def __init__(self):
         pass
 
-    def test(self, pileupread):
-        raise IsBadRead()
+    def classify(self, pileupread, verdicts=None):
+        return IsBadRead.code, None
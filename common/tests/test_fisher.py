@@ -0,0 +1,77 @@
+# Batch exact tests against the scalar ones, and the binomial table.
+# Run with: python -m unittest discover -s common/tests
+
+import sys
+import os.path
+import unittest
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTDIR, '..', 'src'))
+
+import numpy
+from scipy.stats.distributions import binom
+import fisher
+from fisher import fisher_exact, fisher_exact_list, binom_test_high, binom_test_high_batch, binomhalftable
+
+
+def tables(maxM=12):
+    # (x, N, n, M) of every 2x2 table with at most maxM in all
+    for M in range(maxM + 1):
+        for N in range(M + 1):
+            for n in range(M + 1):
+                for x in range(max(0, N - (M - n)), min(n, N) + 1):
+                    yield x, N, n, M
+
+
+class TestFisherExact(unittest.TestCase):
+
+    def assertValues(self, values, expected):
+        # Equal to within 1e-9 relative, and int where expected is
+        for v, e in zip(values, expected):
+            self.assertEqual(isinstance(v, int), isinstance(e, int), (v, e))
+            self.assertTrue(abs(v - e) <= 1e-9 * e, (v, e))
+
+    def test_list(self):
+        rows = list(tables()) + [(0, 0, 0, 10), (1, 1, 1, 1), (3, 3, 7, 7), (2000, 3500, 8711, 15534)]
+        x, N, n, M = numpy.array(rows).T
+        for direction in (None, 'high', 'low'):
+            self.assertValues(fisher_exact_list(x, N, n, M, direction),
+                              [fisher_exact(*row, direction=direction) for row in rows])
+
+    def test_capped(self):
+        # Degenerate tables are tested as 1, not 1.0
+        self.assertEqual(map(repr, fisher_exact_list([0, 1], [0, 1], [0, 1], [10, 1])), ['1', '1'])
+
+
+
+class TestBinomHalfTable(unittest.TestCase):
+
+    def test_values(self):
+        # Table lookups, integral floats and numpy integers included, are
+        # the scipy tail, and counted as hits
+        hits = fisher.binomhalfhits
+        for n, N in [(0, 0), (3, 10), (7.0, 20.0), (numpy.int64(500), numpy.int64(1000))]:
+            expected = 1.0 if n == 0 else binom.sf(n - 1, N, 0.5)
+            self.assertAlmostEqual(binom_test_high(n, N, 0.5), expected, places=12)
+        self.assertEqual(fisher.binomhalfhits, hits + 4)
+        pv = binom_test_high_batch(numpy.array([3, 7.0]), numpy.array([10, 20.0]), 0.5)
+        self.assertEqual(list(pv), [binom_test_high(3, 10, 0.5), binom_test_high(7, 20, 0.5)])
+
+    def test_nonintegral(self):
+        # Non-integral counts are not looked up in the table
+        hits = fisher.binomhalfhits
+        self.assertAlmostEqual(binom_test_high(3.5, 10, 0.5), binom.sf(2.5, 10, 0.5), places=12)
+        self.assertAlmostEqual(binom_test_high_batch(numpy.array([3.5]), numpy.array([10]), 0.5)[0],
+                               binom.sf(2.5, 10, 0.5), places=12)
+        self.assertEqual(fisher.binomhalfhits, hits)
+
+    def test_maxN(self):
+        # Tables of other sizes leave BINOMHALFMAXN alone
+        maxN = fisher.BINOMHALFMAXN
+        self.assertEqual(len(binomhalftable(50)), 51 * 52 // 2)
+        self.assertEqual(fisher.BINOMHALFMAXN, maxN)
+        self.assertEqual(len(binomhalftable()), (maxN + 1) * (maxN + 2) // 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
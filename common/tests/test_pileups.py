@@ -0,0 +1,136 @@
+
+# Pileup engine equivalence on the RNA2DNAlign example alignment files.
+# Run with: python -m unittest discover -s common/tests
+
+import sys
+import os.path
+import unittest
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTDIR, '..', 'src'))
+DATADIR = os.path.join(TESTDIR, '..', '..', 'RNA2DNAlign', 'data')
+
+from chromreg import ChromLabelRegistry
+from pileups import SerialPileups, PrefetchPileups, ShardedPileups, lociGoodReads
+from util import SNVPileupReadFilter, BasicFilter
+from coverage import CoverageBins
+
+SAMPLES = ['GDNA', 'SDNA', 'NRNA', 'TRNA']
+
+
+def exampleloci():
+    # SNV loci of example-SNV.tsv and the example VCF files, in order
+    loci = set()
+    for filename in ['example-SNV.tsv'] + ['example-%s.vcf' % s for s in SAMPLES]:
+        for line in open(os.path.join(DATADIR, filename)):
+            if line.startswith('#') or line.startswith('CHROM'):
+                continue
+            chrom, pos = line.split('\t')[:2]
+            ref, alt = line.split('\t')[2:4] if filename.endswith('.tsv') else line.split('\t')[3:5]
+            if len(ref) == 1 and len(alt) == 1:
+                loci.add((chrom, int(pos), ref, alt.strip()))
+    return loci
+
+
+class TestPileupEngines(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.alignments = [os.path.join(DATADIR, 'example-%s.bam' % s) for s in SAMPLES]
+        loci = exampleloci()
+        cls.chrreg = ChromLabelRegistry()
+        cls.chrreg.add_labels('loci', set(l[0] for l in loci))
+        loci = [(cls.chrreg.label2chrom('loci', l[0]),) + l[1:] for l in loci]
+        for bamfile in cls.alignments:
+            cls.chrreg.add_bamlabels(bamfile)
+        cls.chrreg.determine_chrom_order()
+        cls.loci = [l + (None,) for l in sorted(loci, key=lambda l: (cls.chrreg.chrom_order(l[0]), l[1], l[3]))]
+
+    def counts(self, filter, engine=SerialPileups, **kw):
+        return list(engine(self.loci, self.alignments, filter, self.chrreg, **kw).countsiterator())
+
+    def assertEngines(self, filter, variants, **kw):
+        # The locus pileup counts, with keyword arguments kw, are also
+        # those of each variant, further keyword arguments.
+        expected = self.counts(filter, **kw)
+        self.assertTrue(any(sum(result[4].values()) > 0 for result in expected))
+        for variant in variants:
+            args = dict(kw)
+            args.update(variant)
+            self.assertEqual(self.counts(filter, **args), expected, variant)
+
+    def test_engines(self):
+        self.assertEngines(SNVPileupReadFilter(),
+                           [dict(window=150), dict(fetch=True), dict(fetch=True, window=1000),
+                            dict(verdicts=0), dict(fileorder=True, window=150)])
+
+    def test_prefetch(self):
+        expected = self.counts(SNVPileupReadFilter())
+        self.assertEqual(self.counts(SNVPileupReadFilter(), PrefetchPileups, prefetch=4), expected)
+
+    def test_readahead(self):
+        expected = self.counts(SNVPileupReadFilter())
+        self.assertEqual(self.counts(SNVPileupReadFilter(), PrefetchPileups, prefetch=4, readahead=65536), expected)
+
+    def test_readahead_error(self):
+        # Errors of the read-ahead thread are raised by the iterator
+        class FailedReadahead(PrefetchPileups):
+            def readfiles(self, ahead):
+                raise IOError("read-ahead failed")
+        self.assertRaises(IOError, self.counts, SNVPileupReadFilter(), FailedReadahead, prefetch=4, readahead=65536)
+
+    def test_minreads(self):
+        # Loci skipped once an alignment file has too few good reads
+        self.assertEngines(SNVPileupReadFilter(),
+                           [dict(window=150), dict(fetch=True)], minreads=10)
+
+    def test_goodreads(self):
+        # Downsampled to the median good reads of the loci with minreads,
+        # no column has more good reads than its median.
+        filter = SNVPileupReadFilter()
+        goodreads = lociGoodReads(self.loci, self.alignments, filter, self.chrreg,
+                                  nsample=len(self.loci), minreads=10)
+        self.assertEqual(len(goodreads), len(self.alignments))
+        medians = [sorted(g)[len(g)//2] for g in goodreads]
+        self.assertTrue(all(max(g) > median for g, median in zip(goodreads, medians)))
+        for result in self.counts(filter, downsample=medians):
+            for j, median in enumerate(medians):
+                self.assertTrue(result[6][(j, 'Good')] <= median)
+
+    def test_coverage(self):
+        # Coverage bounds are at least the good reads at each locus, and
+        # only the references of the loci are counted.
+        results = self.counts(SNVPileupReadFilter())
+        for j, bamfile in enumerate(self.alignments):
+            bins = CoverageBins(bamfile, cache=False)
+            chrommap = self.chrreg.chrommap(bamfile)
+            for locus, result in zip(self.loci, results):
+                self.assertTrue(bins.bound(chrommap(locus[0]), locus[1] - 1) >= result[6][(j, 'Good')])
+            self.assertEqual(set(bins.bins), set(chrommap(l[0]) for l in self.loci))
+
+    def test_sharded(self):
+        for minreads in (0, 10):
+            expected = self.counts(SNVPileupReadFilter(), minreads=minreads)
+            self.assertEqual(self.counts(SNVPileupReadFilter(), ShardedPileups, processes=2, shards=3,
+                                         minreads=minreads), expected)
+
+    def test_basecounts(self):
+        self.assertEngines(BasicFilter(),
+                           [dict(basecounts=False), dict(fetch=True), dict(window=150)])
+
+    def test_groupby(self):
+        self.assertEngines(SNVPileupReadFilter(),
+                           [dict(window=150), dict(fetch=True)], groupby='SM')
+
+    def test_groupby_total(self):
+        # Each read group's reads, low base quality ones included, are in
+        # its own column.
+        filter = SNVPileupReadFilter()
+        files = self.counts(filter)
+        groups = self.counts(filter, groupby='SM')
+        for fileresult, groupresult in zip(files, groups):
+            self.assertEqual(sum(fileresult[4].values()), sum(groupresult[4].values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
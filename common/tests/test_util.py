@@ -0,0 +1,59 @@
+
+# Read filter checks on hand-made alignments.
+# Run with: python -m unittest discover -s common/tests
+
+import sys
+import os.path
+import unittest
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTDIR, '..', 'src'))
+
+from pysamimport import pysam
+from pileups import FetchedRead
+from util import SNVPileupReadFilter, GOOD, SNVEditPadding
+
+
+def alignment(md, nm, length=50):
+    # A mapped, unique read of all A's aligned without gaps
+    al = pysam.AlignedSegment()
+    al.query_name = 'read'
+    al.query_sequence = 'A' * length
+    al.flag = 0
+    al.reference_id = 0
+    al.reference_start = 100
+    al.mapping_quality = 60
+    al.cigar = [(0, length)]
+    al.set_tags([('MD', md), ('NM', nm), ('NH', 1)])
+    return al
+
+
+class TestSNVPileupReadFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.filter = SNVPileupReadFilter()
+
+    def substs(self, md):
+        al = alignment(md, 0)
+        return self.filter.editmap(al, [al.qlen]).substs
+
+    def test_md_substitutions(self):
+        # Query positions of the substitutions, after the matching and
+        # substituted bases before each
+        self.assertEqual(self.substs('50'), [])
+        self.assertEqual(self.substs('10A39'), [10])
+        self.assertEqual(self.substs('10A5T33'), [10, 16])
+        self.assertEqual(self.substs('0C0G48'), [0, 1])
+        self.assertEqual(self.substs('49G0'), [49])
+
+    def test_substitution_near_snv(self):
+        al = alignment('10A5T33', 2)
+        code, result = self.filter.classify(FetchedRead(al, 15, 0, False))
+        self.assertEqual(code, SNVEditPadding.code)
+        code, result = self.filter.classify(FetchedRead(al, 30, 0, False))
+        self.assertEqual(code, GOOD)
+        self.assertEqual(result[1:3], (30, 'A'))
+
+
+if __name__ == '__main__':
+    unittest.main()